@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Benchmarks the five better-git commands on a synthetic repository (see synthrepo.py). Each command
+## is run as its own process with scripted answers on stdin, and the wall time, number of git
+## subprocesses (counted with the BETTER_GIT_TRACE trace) and peak RSS are reported per phase.
+## Everything runs offline against a bare repository on the local filesystem.
+##
+## usage: python3 bench/bench.py [--commits N] [--files N] [--branches N] [--loose-refs] [--json results.json]
+from subprocess import Popen, PIPE, DEVNULL
+import os, sys, time, json, tempfile, shutil, argparse
+from os import path
+from synthrepo import make_repo, git_output
+
+SCRIPT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+def run_phase(name, script, answers, work_dir):
+	## runs one better-git script with the given answers, returns a dict of measurements
+	trace_file = path.join(tempfile.gettempdir(), 'better-git-bench-%s-%s.json' % (os.getpid(), name))
+	env = dict(os.environ, BETTER_GIT_TRACE=trace_file)
+	start = time.perf_counter()
+	p = Popen([sys.executable, path.join(SCRIPT_DIR, script)], cwd=work_dir, env=env,
+			  stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL, close_fds=True)
+	p.stdin.write(('\n'.join(answers) + '\n').encode('utf8'))
+	p.stdin.close()
+	## wait4 gives the resource usage of just this process (and the git processes it waited for)
+	_, status, usage = os.wait4(p.pid, 0)
+	p.returncode = os.waitstatus_to_exitcode(status)
+	wall = time.perf_counter() - start
+	git_calls = None
+	if path.exists(trace_file):
+		with open(trace_file, 'r') as fin:
+			git_calls = len([ev for ev in json.load(fin)['traceEvents'] if ev['cat'] == 'git'])
+		os.remove(trace_file)
+	## ru_maxrss is in kilobytes on Linux (bytes on macOS)
+	peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+	return {'phase': name, 'ok': p.returncode == 0, 'wall_s': wall, 'git_calls': git_calls, 'peak_rss_mb': peak_rss_mb}
+
+def menu_number(options, choice):
+	return str(options.index(choice) + 1)
+def branches(work_dir, prefix):
+	return [x[len(prefix):] for x in git_output('-C', work_dir, 'for-each-ref', '--format', '%(refname)', prefix)]
+
+def run_benchmark(work_dir):
+	results = []
+	## fork: new local branch from origin/main
+	remotes = ['origin/' + b for b in branches(work_dir, 'refs/remotes/origin/')]
+	results.append(run_phase('fork', 'fork.py', [menu_number(remotes, 'origin/main'), 'bench-fork'], work_dir))
+	## commit: change a few files and add one
+	tracked = git_output('-C', work_dir, 'ls-files')[:10]
+	for f in tracked:
+		with open(path.join(work_dir, f), 'a') as fout: fout.write('bench\n')
+	with open(path.join(work_dir, 'bench-new-file.txt'), 'w') as fout: fout.write('bench\n')
+	results.append(run_phase('commit', 'commit.py', ['y', 'bench commit', '', 'y'], work_dir))
+	## branch: auto-named branch from the HEAD of the current branch
+	results.append(run_phase('branch', 'branch.py', ['1', '1', '', 'y'], work_dir))
+	## merge: main into the current branch
+	local = branches(work_dir, 'refs/heads/')
+	current = git_output('-C', work_dir, 'symbolic-ref', '--short', 'HEAD')[0]
+	results.append(run_phase('merge', 'merge.py', [menu_number(local, 'main'), menu_number(local, current), 'y'], work_dir))
+	## push: the current branch as a new remote branch
+	results.append(run_phase('push', 'push.py', ['1', 'bench-push', 'y'], work_dir))
+	return results
+
+def print_results(results):
+	print('%-8s %5s %10s %10s %14s' % ('phase', 'ok', 'wall (s)', 'git calls', 'peak RSS (MB)'))
+	for r in results:
+		print('%-8s %5s %10.3f %10s %14.1f' % (r['phase'], 'yes' if r['ok'] else 'NO', r['wall_s'],
+											  '?' if r['git_calls'] is None else r['git_calls'], r['peak_rss_mb']))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the better-git commands on a synthetic repository')
+	parser.add_argument('--commits', type=int, default=1000)
+	parser.add_argument('--files', type=int, default=1000)
+	parser.add_argument('--branches', type=int, default=10)
+	parser.add_argument('--loose-refs', action='store_true', help='leave refs loose instead of packing them')
+	parser.add_argument('--keep', action='store_true', help='keep the generated repositories')
+	parser.add_argument('--json', help='also write the results to this file')
+	args = parser.parse_args()
+	dest = tempfile.mkdtemp(prefix='better-git-bench-')
+	try:
+		start = time.perf_counter()
+		work_dir = make_repo(dest, args.commits, args.files, args.branches, not args.loose_refs)
+		print('Generated %s commits, %s files, %s branches in %.1fs (%s)' % (
+			args.commits, args.files, args.branches, time.perf_counter() - start, dest))
+		results = run_benchmark(work_dir)
+		print_results(results)
+		if args.json is not None:
+			with open(args.json, 'w') as fout:
+				json.dump({'commits': args.commits, 'files': args.files, 'branches': args.branches,
+						   'packed_refs': not args.loose_refs, 'results': results}, fout, indent=1)
+	finally:
+		if not args.keep: shutil.rmtree(dest, ignore_errors=True)
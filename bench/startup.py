@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Startup budget check: measures how long it takes to start Python and load each better-git command
+## through the better-git dispatcher (everything before the command's first git call or prompt), and
+## exits with an error if the median time of any command is over the budget.
+## The budget is for better-git's own share of the startup time, on top of starting Python and importing
+## subprocess (which every git front-end needs, and which takes anywhere from 15 to 50 ms depending on the
+## machine). Use --absolute to hold the whole startup time to the budget instead.
+##
+## usage: python3 bench/startup.py [--budget-ms 20] [--absolute] [--runs 15]
+from subprocess import call, DEVNULL
+import sys, time, statistics, argparse
+from os import path
+
+SCRIPT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+COMMANDS = ('fork', 'commit', 'branch', 'merge', 'push')
+
+def median_ms(argv, runs):
+	times = []
+	for _ in range(runs):
+		start = time.perf_counter()
+		if call(argv, stdin=DEVNULL) != 0:
+			raise RuntimeError('failed to run %s' % ' '.join(argv))
+		times.append((time.perf_counter() - start) * 1000)
+	return statistics.median(times)
+def startup_time(command, runs):
+	code = 'import sys; sys.path.insert(0, %r); import better_git; better_git.load_command(%r)' % (SCRIPT_DIR, command)
+	return median_ms([sys.executable, '-c', code], runs)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Check the startup time of the better-git commands')
+	parser.add_argument('--budget-ms', type=float, default=None, help='default: 20 ms, or 50 ms with --absolute')
+	parser.add_argument('--absolute', action='store_true', help='apply the budget to the whole startup time')
+	parser.add_argument('--runs', type=int, default=15)
+	args = parser.parse_args()
+	budget = args.budget_ms if args.budget_ms is not None else (50.0 if args.absolute else 20.0)
+	baseline = 0.0 if args.absolute else median_ms([sys.executable, '-c', 'import subprocess'], args.runs)
+	print('%-8s %12s %14s' % ('command', 'startup (ms)', 'better-git (ms)'))
+	if not args.absolute: print('%-8s %12.1f' % ('baseline', baseline))
+	over = []
+	for command in COMMANDS:
+		ms = startup_time(command, args.runs)
+		print('%-8s %12.1f %14.1f' % (command, ms, ms - baseline))
+		if ms - baseline > budget: over.append(command)
+	if len(over) > 0:
+		print('Over the %.0f ms startup budget: %s' % (budget, ', '.join(over)))
+		sys.exit(1)
+	print('All commands start within the %.0f ms budget.' % budget)
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Generates synthetic git repositories for benchmarking: a bare "remote" repository filled with
+## `git fast-import`, and a clone of it to run the better-git commands in. Everything stays on the local
+## filesystem, so benchmarks run offline.
+from subprocess import call, Popen, PIPE, DEVNULL
+import os, sys, random, argparse
+from os import path
+
+def make_repo(dest, commits=1000, files=1000, branches=10, packed_refs=True, seed=1):
+	## creates dest/remote.git and dest/work, returns the path of the work repository
+	remote_dir = path.join(dest, 'remote.git')
+	work_dir = path.join(dest, 'work')
+	os.makedirs(dest, exist_ok=True)
+	git('init', '-q', '--bare', '-b', 'main', remote_dir)
+	p = Popen(['git', '-C', remote_dir, 'fast-import', '--quiet'], stdin=PIPE, close_fds=True)
+	rng = random.Random(seed)
+	file_names = ['src/d%s/f%s.txt' % (i % 97, i) for i in range(files)]
+	branch_at = set(rng.sample(range(commits), min(branches, commits)))
+	timestamp = 1600000000
+	branch_count = 0
+	for c in range(commits):
+		timestamp += 60
+		msg = 'Synthetic commit %s' % c
+		out = ['commit refs/heads/main', 'mark :%s' % (c+1),
+			   'committer Bench <bench@example.com> %s +0000' % timestamp, 'data %s' % len(msg), msg]
+		if c > 0: out.append('from :%s' % c)
+		changed = file_names if c == 0 else rng.sample(file_names, min(3, files))
+		p.stdin.write(('\n'.join(out) + '\n').encode('utf8'))
+		for f in changed:
+			content = ('%s %s\n' % (f, c)).encode('utf8')
+			p.stdin.write(('M 100644 inline %s\ndata %s\n' % (f, len(content))).encode('utf8') + content + b'\n')
+		p.stdin.write(b'\n')
+		if c in branch_at:
+			p.stdin.write(('reset refs/heads/feature-%s\nfrom :%s\n\n' % (branch_count, c+1)).encode('utf8'))
+			branch_count += 1
+	p.stdin.close()
+	if p.wait() != 0:
+		raise RuntimeError('git fast-import failed')
+	git('clone', '-q', remote_dir, work_dir)
+	git('-C', work_dir, 'config', 'user.name', 'Bench')
+	git('-C', work_dir, 'config', 'user.email', 'bench@example.com')
+	## local copies of the remote branches, so the branch menus have something in them
+	for ln in git_output('-C', work_dir, 'for-each-ref', '--format', '%(refname:short)', 'refs/remotes/origin/'):
+		name = ln[len('origin/'):]
+		if name not in ('HEAD', 'main') and '/' not in name:
+			git('-C', work_dir, 'branch', '-q', name, ln)
+	if packed_refs:
+		git('-C', work_dir, 'pack-refs', '--all')
+	else:
+		unpack_refs(work_dir)
+	return work_dir
+def unpack_refs(work_dir):
+	## rewrites packed-refs as loose ref files
+	git_dir = path.join(work_dir, '.git')
+	for ln in git_output('-C', work_dir, 'for-each-ref', '--format', '%(objectname) %(refname) %(symref)'):
+		parts = ln.split(' ')
+		if len(parts[2]) > 0: continue # symbolic refs are always loose
+		ref_file = path.join(git_dir, *parts[1].split('/'))
+		os.makedirs(path.dirname(ref_file), exist_ok=True)
+		with open(ref_file, 'w') as fout:
+			fout.write(parts[0] + '\n')
+	packed = path.join(git_dir, 'packed-refs')
+	if path.exists(packed): os.remove(packed)
+def git(*args):
+	if call(['git'] + list(args), stdin=DEVNULL) != 0:
+		raise RuntimeError('git %s failed' % ' '.join(args))
+def git_output(*args):
+	p = Popen(['git'] + list(args), stdin=DEVNULL, stdout=PIPE, close_fds=True)
+	o, _ = p.communicate()
+	return [x for x in o.decode('utf8').split('\n') if len(x) > 0]
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generate a synthetic git repository (and bare remote) for benchmarking')
+	parser.add_argument('dest', help='folder to create the repositories in')
+	parser.add_argument('--commits', type=int, default=1000)
+	parser.add_argument('--files', type=int, default=1000)
+	parser.add_argument('--branches', type=int, default=10)
+	parser.add_argument('--loose-refs', action='store_true', help='leave refs loose instead of packing them')
+	args = parser.parse_args()
+	print(make_repo(args.dest, args.commits, args.files, args.branches, not args.loose_refs))
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Single entry point for all the better-git commands: `better-git fork|commit|branch|merge|push`.
+## Only the module of the chosen command is imported, and the commands can also be called from other
+## Python programs, eg `better_git.merge()`, which runs the command in-process and returns its exit code.
+import sys, importlib
+
+COMMANDS = ('fork', 'commit', 'branch', 'merge', 'push')
+
+def load_command(name):
+	if name not in COMMANDS:
+		raise ValueError('unknown better-git command "%s"' % name)
+	return importlib.import_module(name)
+def run_command(name):
+	## runs a command in this process, returns its exit code
+	module = load_command(name)
+	reset_shared_state()
+	try:
+		module.main()
+		return 0
+	except SystemExit as e:
+		if e.code is None: return 0
+		return e.code if isinstance(e.code, int) else 1
+def reset_shared_state():
+	## drops the ref snapshot, ref index and cat-file session left by an earlier command, so the next one
+	## sees the refs as they are now (and the repository of the current folder); only modules already
+	## loaded can hold any of them
+	snapshot_module = sys.modules.get('refsnapshot')
+	if snapshot_module is not None and snapshot_module._snapshot is not None:
+		snapshot_module._snapshot.close()
+		snapshot_module._snapshot = None
+	index_module = sys.modules.get('refindex')
+	if index_module is not None: index_module._index = None
+	catfile_module = sys.modules.get('catfile')
+	if catfile_module is not None and catfile_module._batch is not None:
+		catfile_module._batch.close()
+		catfile_module._batch = None
+def fork():
+	return run_command('fork')
+def commit():
+	return run_command('commit')
+def branch():
+	return run_command('branch')
+def merge():
+	return run_command('merge')
+def push():
+	return run_command('push')
+
+def main():
+	if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+		print('usage: better-git %s [options]' % '|'.join(COMMANDS))
+		sys.exit(1)
+	## the commands read their own options (eg merge --forecast) from sys.argv
+	command = sys.argv[1]
+	sys.argv = ['better-git %s' % command] + sys.argv[2:]
+	sys.exit(run_command(command))
+#
+if __name__ == '__main__':
+	main()
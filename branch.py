@@ -3,75 +3,109 @@
 # Copyright 2021 Christopher C. Hall
 # Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
 # https://creativecommons.org/licenses/by/4.0/
-from subprocess import call, Popen, PIPE, STDOUT
-import os, sys, re
+from subprocess import PIPE, STDOUT, DEVNULL
+import os, sys, re, threading
 from os import path
+from core import run, confirm, choose_from, ask_for_text
+from gittrace import Popen
+from refsnapshot import ref_snapshot
+from refindex import ref_index
+from commitgraph import CommitGraph
+from branchnotes import branch_notes
+from catfile import cat_file
+from commitindex import open_commit_index
+from daemonclient import daemon_log_page
 
 def main():
 	# first, check if there are uncommitted changes and abort if so
+	## always asked of git: a cached answer could miss an edit made a moment ago
 	changes = run('git', 'status', '-uall', '--porcelain', capture_stdout=True, fail_msg='Cannot branch, current working directory is not in a git repository!')
 	## with --porcelain, changes will be an empty string if there are no uncommitted changes
 	if len(changes.strip()) > 0:
 		## uncommitted changes detected, abort
 		print('Error: uncommitted changes detected! Commit first and then branch.')
-		exit(1)
+		sys.exit(1)
 	# then ask for a branch and commit to branch from
-	this_branch = run('git', 'symbolic-ref', '--short', '-q', 'HEAD',
-					  capture_stdout=True).strip()
-	branch_list = [x for x in run('git', 'for-each-ref', '--format', '%(refname:short)', 'refs/heads/',
-								  capture_stdout=True).replace('\r', '').split('\n') if len(x) > 0]  # necessary because git prints an extra new-line!
+	refs = ref_snapshot()
+	this_branch = refs.current_branch()
+	branch_list = refs.branches()
 	options = ['current branch (%s)' % this_branch] + branch_list
-	index, history_branch = choose_from('Which branch do you want to branch from?', options)
+	index, history_branch = choose_from('Which branch do you want to branch from?', options, keep_listed=1, notes=branch_notes(branch_list))
 	if index == 0:
 		history_branch = this_branch
 
-	## get entire history
-	commits = [ln for ln in # note: , '--no-pager' MUST come between 'git' and the git command name (because git is git)
-					run('git', '--no-pager', 'log', history_branch, '--date=short', '--pretty=%H  %ad  %an  %s', capture_stdout=True)
-					.replace('\r', '').split('\n') if len(ln.strip()) > 0]
+	## page through the history a few commits at a time, only asking git for the pages that are shown
 	## first 40 digits are the long hash (first 7 are the short hash)
-	## show the user a few commits at a time
 	entry_count = 10
+	## the commit-graph file (if git has written one) lets us count and search the history without git log
+	tip = cat_file().resolve(history_branch + '^{commit}')
+	if tip is None:
+		print('Error: branch %s has no commits to branch from' % history_branch)
+		sys.exit(1)
+	pager = LogPager(history_branch, entry_count, tip)
+	graph = CommitGraph.open(run('git', 'rev-parse', '--git-path', 'objects', capture_stdout=True).strip())
+	## counting walks the whole history, so it is only done when the user jumps (and then only once)
+	commit_count = None
 	log_start = 0
+	prev_start = 0
 	while True:
-		log_end = log_start + entry_count
+		commits, has_next = pager.page(log_start)
+		if len(commits) == 0:
+			if log_start == 0:
+				print('Error: branch %s has no commits to branch from' % history_branch)
+				sys.exit(1)
+			print('No commits that far back.')
+			log_start = prev_start
+			continue
+		prev_start = log_start
 		options=[]
 		if log_start != 0:
 			options.append('<<< PREVIOUS <<<')
 		else:
 			options.append('HEAD')
-		for ln in commits[log_start:min(log_end,len(commits))]: options.append(ln[0:7]+ln[40:])
-		if log_end < len(commits):
+		for ln in commits: options.append(ln[0:7]+ln[40:])
+		if has_next:
 			options.append('>>> NEXT >>>')
+		options.append('>>> JUMP TO... >>>')
+		options.append('>>> SEARCH... >>>')
 		index, choice = choose_from('Choose a commit to branch from:', options)
 		if choice == '>>> NEXT >>>':
-			if log_end < len(commits):
-				log_start = log_end
+			log_start += entry_count
+		elif choice == '>>> JUMP TO... >>>':
+			if commit_count is None and graph is not None: commit_count = graph.count_reachable(tip)
+			target = ask_for_text('Jump to commit number%s or commit date (YYYY-MM-DD)' % (
+				'' if commit_count is None else ' (1-%s)' % commit_count)).strip()
+			if re.match('^\\d+$', target):
+				log_start = max(0, int(target) - 1)
+			elif re.match('^\\d{4}-\\d{2}-\\d{2}$', target):
+				log_start = commits_after_date(graph, tip, target)
+			else:
+				print('Not a commit number or date, try again.')
+		elif choice == '>>> SEARCH... >>>':
+			if (found := search_history(history_branch, tip)) is not None:
+				commit_line = found
+				break
 		elif choice == '<<< PREVIOUS <<<':
-			log_start -= entry_count
+			log_start = max(0, log_start - entry_count)
 		elif choice == 'HEAD':
-			commit_index = 0
+			commit_line = commits[0]
 			break
 		else:
-			commit_index = index + log_start-1
+			commit_line = commits[index-1]
 			break
-	full_hash = commits[commit_index][0:40]
+	pager.close()
+	if graph is not None: graph.close()
+	full_hash = commit_line[0:40]
 	print('Branching from commit %s' % full_hash)
-	print('%s' % commits[commit_index][40:])
+	print('%s' % commit_line[40:])
 
 	# then ask for a new branch name (or automatically make one)
 	bname = ask_for_text('New branch name? (leave blank to auto-name)').strip()
 	if len(bname) == 0:
-		## generate a unique branch name
-		remote_branches = [x for x in
-										 run('git', 'for-each-ref', '--format', '%(refname:short)', 'refs/remotes/',
-											 capture_stdout=True).replace('\r', '').split('\n') if len(x) > 0]
-		all_branches = [x[x.find('/')+1:] for x in branch_list + remote_branches]
+		## generate a unique branch name (not used by any local or remote branch)
 		ref_branch = history_branch
 		if '.' in ref_branch: ref_branch = ref_branch[:ref_branch.rfind('.')]
-		i = 1
-		while (bname := '%s.%s' % (ref_branch, i)) in all_branches:
-			i += 1
+		bname = ref_index().next_free_name(ref_branch)
 
 	# finally, make the new branch
 	if confirm('Create new branch %s from commit %s?' % (bname, full_hash[0:7])):
@@ -80,55 +114,104 @@ def main():
 	# Done!
 	print('Done!')
 #
-def ask_for_text(msg, **kwargs):
-	print("%s: " % msg, **kwargs)
-	return input()
-def confirm(msg):
-	while True:
-		r = input('%s [y/n]: ' % msg).strip().lower()
-		if r == 'y' or r == 'yes':
-			return True
-		elif r == 'n' or r == 'no':
-			return False
-		else:
-			continue
-def choose_from(msg, options_list):
-	while True:
+def commits_after_date(graph, tip, date_str):
+	## number of commits that git log lists before the first commit from on or before the given date
+	## (the committer date, which is the date the pages show and the order git log lists them in)
+	from datetime import datetime, timedelta
+	timestamp = int((datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=1)).timestamp())
+	if graph is not None and (skip := graph.count_newer_than(tip, timestamp)) is not None:
+		return skip
+	## no commit-graph (or the tip is newer than it), let git count instead
+	return int(run('git', 'rev-list', '--count', '--since=@%s' % timestamp, tip, capture_stdout=True).strip())
+def search_history(branch, tip):
+	## asks for search queries until a commit is chosen, returns its log line (or None to go back to paging)
+	index = open_commit_index(ref_snapshot().dir.common_dir)
+	if index is None:
+		print('Error: searching needs the sqlite3 module, which this Python does not have')
+		return None
+	try:
 		try:
-			print(msg)
-			num = 1
-			for opt in options_list:
-				print('%s:\t%s' % (num, opt))
-				num += 1
-			r = input('Enter number: ')
-			i = int(r)-1
-			return i, options_list[i]
-		except ValueError:
-			print('Not a number, try again.')
-		except IndexError:
-			print('Not a valid option, try again.')
-def run(command, *args, fail_msg=None, capture_stdout=False):
-	args = list(args) # convert tuple to list
-	if fail_msg == None:
-		fail_msg = "Error: non-zero exit code returned by %s %s" % (command," ".join(args))
-	if capture_stdout == False:
-		exit_code = call([command]+args)
-		ret_val = None
-	else:
-		p = Popen([command]+args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		o, e = p.communicate()
-		if e is not None and len(e) > 0: print(e.decode('utf8'), file=sys.stderr)
-		ret_val = o.decode('utf8')
-		exit_code = p.returncode
-	if exit_code != 0:
-		print(fail_msg)
-		exit(1)
-	return ret_val
-def test_run(command, *args):
-	args = list(args)
-	p = Popen([command] + args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-	exit_code = p.wait()
-	return exit_code == 0
+			index.update(branch, tip)
+		except RuntimeError as e:
+			print('Error: %s' % e)
+			return None
+		while True:
+			query = ask_for_text('Search for (words in the message, author:name, since:YYYY-MM-DD, until:YYYY-MM-DD and/or the start of a hash; blank to go back)').strip()
+			if len(query) == 0:
+				return None
+			try:
+				found = index.search(branch, query)
+			except ValueError:
+				print('Dates must be YYYY-MM-DD, try again.')
+				continue
+			if len(found) == 0:
+				print('No commits found, try again.')
+				continue
+			options = [ln[0:7]+ln[40:] for ln in found] + ['<<< NEW SEARCH <<<', '<<< BACK <<<']
+			index_chosen, choice = choose_from('Choose a commit to branch from:', options)
+			if choice == '<<< BACK <<<':
+				return None
+			elif choice != '<<< NEW SEARCH <<<':
+				return found[index_chosen]
+	finally:
+		index.close()
+class LogPager:
+	## Reads the history of a branch one page at a time with a bounded `git log --skip=N -n M`, so the
+	## first page costs the same no matter how long the history is. While the user looks at a page, the
+	## next one is fetched in a background thread. Only the pages around the current one are kept.
+	def __init__(self, branch, page_size, tip=None):
+		self.branch = branch
+		self.page_size = page_size
+		self.tip = tip # the commit the branch points to (lets the repository daemon cache the pages)
+		self._pages = {} # page start -> (exit code, lines)
+		self._prefetch = {} # page start -> Thread
+		self._lock = threading.Lock()
+	def page(self, start):
+		## returns (list of log lines, True if there is a page after this one)
+		if start in self._prefetch:
+			self._prefetch.pop(start).join()
+		with self._lock:
+			result = self._pages.get(start)
+		if result is None:
+			result = self._fetch(start)
+		code, lines = result
+		if code != 0:
+			print('Error: failed to read history of %s' % self.branch)
+			sys.exit(1)
+		with self._lock:
+			## keep memory flat: only the previous, current, and next pages are retained
+			keep = (start - self.page_size, start, start + self.page_size)
+			for k in [k for k in self._pages if k not in keep]: del self._pages[k]
+		has_next = len(lines) > self.page_size
+		if has_next and (start + self.page_size) not in self._pages and (start + self.page_size) not in self._prefetch:
+			t = threading.Thread(target=self._fetch, args=(start + self.page_size,), daemon=True)
+			self._prefetch[start + self.page_size] = t
+			t.start()
+		return lines[:self.page_size], has_next
+	def close(self):
+		for t in self._prefetch.values(): t.join()
+		self._prefetch.clear()
+		self._pages.clear()
+	def _fetch(self, start):
+		## ask for one extra line to find out whether there is a next page
+		result = None
+		if self.tip is not None:
+			result = daemon_log_page(ref_snapshot().dir.git_dir, self.tip, start, self.page_size + 1)
+		if result is None:
+			result = read_log_page(self.branch, start, self.page_size + 1)
+		with self._lock:
+			self._pages[start] = result
+		return result
+def read_log_page(rev, start, count):
+	## returns (exit code, lines) of the log of rev, skipping the first start commits
+	## note: '--no-pager' MUST come between 'git' and the git command name (because git is git)
+	## the committer date (%cd) is shown, as that is what git log orders by and what a jump to a date uses
+	p = Popen(['git', '--no-pager', 'log', rev, '--date=short', '--pretty=%H  %cd  %an  %s',
+			   '--skip=%s' % start, '-n', str(count), '--'],
+			  stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	lines = [ln for ln in o.decode('utf8').replace('\r', '').split('\n') if len(ln.strip()) > 0]
+	return p.returncode, lines
 #
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Notes shown next to the branches in the menus: how many commits each branch is ahead and behind the
+## current branch, the date of its last commit, and its subject. Everything comes from one for-each-ref
+## (git 2.41 and later can count ahead/behind itself, with the ahead-behind atom), or on older versions
+## from one for-each-ref plus one walk of the history shared by all branches, never one git call per
+## branch.
+##
+## The shared walk reads `git rev-list --date-order --parents` from all the branch tips and the current
+## commit together, and gives each commit a bit mask of the tips (and the current commit) it can be
+## reached from; a commit always comes after its children, so its mask is complete when it is read. A
+## commit that is reached from a tip but not from the current commit counts as ahead for that tip, and
+## the other way around as behind. The walk stops as soon as every commit still waiting to be read is
+## reachable from everything, since all the history below that counts for nobody.
+from subprocess import PIPE, DEVNULL
+from gittrace import Popen
+
+## for-each-ref fields, separated by \0
+REF_FORMAT = '%(refname)%00%(objectname)%00%(committerdate:short)%00%(subject)'
+MAX_SUBJECT = 60
+
+def branch_notes(names, remote=False, base='HEAD'):
+	## {name: note} for branch names as listed in the menus (eg 'main', or 'origin/main' with remote=True).
+	## Returns an empty dict if the notes can't be worked out (eg no commits yet).
+	prefix = 'refs/remotes/' if remote else 'refs/heads/'
+	wanted = {prefix + n: n for n in names}
+	refs = _for_each_ref(prefix, base)
+	if refs is None: return {}
+	refs = {r: info for r, info in refs.items() if r in wanted}
+	if len(refs) == 0: return {}
+	if any(info[3] is None for info in refs.values()):
+		## git older than 2.41, count them with one shared walk instead
+		counts = ahead_behind(base, list(dict.fromkeys(info[0] for info in refs.values())))
+		if counts is None: return {}
+		refs = {r: (oid, date, subject, counts[oid]) for r, (oid, date, subject, _) in refs.items()}
+	notes = {}
+	for r, (oid, date, subject, (ahead, behind)) in refs.items():
+		if len(subject) > MAX_SUBJECT: subject = subject[:MAX_SUBJECT-3] + '...'
+		notes[wanted[r]] = '%s  %s  %s' % (date, _counts(ahead, behind), subject)
+	return notes
+def ahead_behind(base, tips):
+	## {tip: (commits ahead of base, commits behind base)} for each commit hash in tips, from one
+	## walk of the history. Returns None if base is not a commit.
+	base_bit = 1 << len(tips)
+	full = (base_bit << 1) - 1
+	masks = {} # commit -> mask of the tips (and base) it is reachable from, for commits not read yet
+	for i, tip in enumerate(tips): masks[tip] = masks.get(tip, 0) | (1 << i)
+	p = Popen(['git', 'rev-parse', '--verify', '--quiet', base + '^{commit}'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	base_oid = o.decode('utf8').strip()
+	if p.returncode != 0 or len(base_oid) == 0: return None
+	masks[base_oid] = masks.get(base_oid, 0) | base_bit
+	waiting = sum(1 for m in masks.values() if m != full) # commits in masks that not everything reaches
+	by_mask = {} # mask -> number of commits read with that mask
+	p = Popen(['git', 'rev-list', '--date-order', '--parents', '--stdin'], stdin=PIPE, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	p.stdin.write(''.join(c + '\n' for c in masks).encode('utf8'))
+	p.stdin.close()
+	for line in p.stdout:
+		commit, *parents = line.decode('utf8').split()
+		m = masks.pop(commit, 0)
+		if m != full:
+			waiting -= 1
+			by_mask[m] = by_mask.get(m, 0) + 1
+		for parent in parents:
+			old = masks.get(parent)
+			new = m if old is None else old | m
+			waiting += (new != full) - (old is not None and old != full)
+			masks[parent] = new
+		if waiting == 0:
+			break # everything below here is reachable from everything
+	p.kill()
+	p.stdout.close()
+	p.wait()
+	## there are few distinct masks, so count per mask first and hand the counts out to the tips once
+	ahead = [0] * len(tips)
+	behind = [0] * len(tips)
+	for m, n in by_mask.items():
+		if m & base_bit:
+			bits, counts = ~m & (base_bit - 1), behind
+		else:
+			bits, counts = m, ahead
+		while bits:
+			low = bits & -bits
+			counts[low.bit_length() - 1] += n
+			bits ^= low
+	return {tip: (ahead[i], behind[i]) for i, tip in enumerate(tips)}
+
+def _for_each_ref(prefix, base):
+	## {refname: (hash, date, subject, (ahead, behind) or None)}, or None if git failed
+	for atoms in ('%%00%%(ahead-behind:%s)' % base, ''):
+		p = Popen(['git', 'for-each-ref', '--format=' + REF_FORMAT + atoms, prefix], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+		o, _ = p.communicate()
+		if p.returncode == 0: break
+	else:
+		return None
+	refs = {}
+	for line in o.decode('utf8', errors='replace').split('\n'):
+		fields = line.split('\0')
+		if len(fields) < 4: continue
+		counts = tuple(int(x) for x in fields[4].split()) if len(fields) > 4 else None
+		refs[fields[0]] = (fields[1], fields[2], fields[3], counts)
+	return refs
+def _counts(ahead, behind):
+	if ahead == 0 and behind == 0: return '%-20s' % 'up to date'
+	return '%-20s' % ', '.join(([('%s ahead' % ahead)] if ahead > 0 else []) + ([('%s behind' % behind)] if behind > 0 else []))
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## A long-lived `git cat-file --batch-check` process for object questions (does it exist, what type and
+## size is it, what hash does this rev name resolve to). Starting git once and asking many questions
+## over the same pipe is much cheaper than spawning one git process per question.
+from subprocess import PIPE, DEVNULL
+import atexit
+from gittrace import Popen
+
+class CatFileBatch:
+	def __init__(self):
+		self.p = None
+	def _start(self):
+		if self.p is None or self.p.poll() is not None:
+			self.p = Popen(['git', 'cat-file', '--batch-check=%(objectname) %(objecttype) %(objectsize)'],
+						   stdin=PIPE, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+		return self.p
+	def query_many(self, revs, chunk_size=512):
+		## returns a list with (hash, type, size) for each rev, or None for revs that don't exist.
+		## Requests are written in chunks before reading the answers, so a whole menu's worth of revs
+		## costs one round trip per chunk instead of one per rev.
+		results = []
+		for i in range(0, len(revs), chunk_size):
+			chunk = revs[i:i+chunk_size]
+			try:
+				p = self._start()
+				## rev names can't contain newlines, and an empty line would make cat-file print nothing
+				p.stdin.write(b''.join((r if len(r) > 0 and '\n' not in r else '-').encode('utf8') + b'\n' for r in chunk))
+				p.stdin.flush()
+				for _ in chunk:
+					fields = p.stdout.readline().decode('utf8').rstrip('\n').split(' ')
+					if len(fields) == 3 and fields[1] not in ('missing', 'ambiguous'):
+						results.append((fields[0], fields[1], int(fields[2])))
+					else:
+						results.append(None)
+			except (OSError, ValueError):
+				## git went away (eg not in a git repository)
+				self.close()
+				results += [None] * (len(chunk) - (len(results) - i))
+		return results
+	def query(self, rev):
+		return self.query_many([rev])[0]
+	def exists(self, rev):
+		return self.query(rev) is not None
+	def object_type(self, rev):
+		info = self.query(rev)
+		return None if info is None else info[1]
+	def object_size(self, rev):
+		info = self.query(rev)
+		return None if info is None else info[2]
+	def resolve(self, rev):
+		## returns the full hash that rev names, or None
+		info = self.query(rev)
+		return None if info is None else info[0]
+	def close(self):
+		if self.p is not None:
+			try:
+				self.p.stdin.close()
+			except OSError:
+				pass
+			self.p.wait()
+			self.p = None
+
+_batch = None
+def cat_file():
+	## the shared session used by all the better-git commands, started on first use
+	global _batch
+	if _batch is None:
+		_batch = CatFileBatch()
+		atexit.register(_batch.close)
+	return _batch
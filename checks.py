@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Runs the configured checks (linters, tests, ...) on the files about to be committed or pushed. Each
+## check is a command that is run once per changed file, with the file's path appended, and passes if it
+## exits with 0. The files are checked in parallel, and every result is remembered by command and blob
+## hash in .git/better-git-check-cache.sqlite, so a file is never checked twice with the same content.
+##
+## Checks are set up in git config, one subsection per check:
+##   git config better-git-check.flake8.command "flake8 --max-line-length=120"
+##   git config better-git-check.flake8.files "*.py"     (optional, space-separated patterns, default all files)
+## Other settings:
+##   better-git.checkjobs         how many checks to run at once (default: the number of CPUs)
+##   better-git.checkcachesize    how many results to keep, the least recently used are dropped (default 100000)
+from subprocess import PIPE, STDOUT, DEVNULL
+import os, sys, time, fnmatch, shlex
+from os import path
+from gittrace import Popen
+from refsnapshot import ref_snapshot
+from core import git_output
+
+CACHE_FILE = 'better-git-check-cache.sqlite'
+DEFAULT_CACHE_SIZE = 100000
+## only this much of the output of a failed check is kept
+MAX_OUTPUT = 8000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (command TEXT, blob TEXT, passed INTEGER, output TEXT, used REAL,
+	PRIMARY KEY (command, blob)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+'''
+
+class Check:
+	def __init__(self, name, command, patterns):
+		self.name = name
+		self.command = command
+		self.patterns = patterns
+	def applies_to(self, filename):
+		if len(self.patterns) == 0: return True
+		## patterns without a / match the file name in any folder, like in .gitignore
+		return any(fnmatch.fnmatch(filename if '/' in p else path.basename(filename), p) for p in self.patterns)
+
+class CheckCache:
+	def __init__(self, filename, max_size=DEFAULT_CACHE_SIZE):
+		import sqlite3
+		self.db = sqlite3.connect(filename)
+		self.db.executescript(SCHEMA)
+		self.max_size = max_size
+	def get(self, command, blob):
+		## (passed, output), or None if not checked yet
+		row = self.db.execute('SELECT passed, output FROM results WHERE command = ? AND blob = ?', (command, blob)).fetchone()
+		return None if row is None else (bool(row[0]), row[1])
+	def touch_many(self, keys):
+		## marks the (command, blob) results in keys as just used
+		now = time.time()
+		with self.db:
+			self.db.executemany('UPDATE results SET used = ? WHERE command = ? AND blob = ?', [(now, c, b) for c, b in keys])
+	def put_many(self, results):
+		## results is a list of (command, blob, passed, output)
+		now = time.time()
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO results (command, blob, passed, output, used) VALUES (?, ?, ?, ?, ?)',
+								[(c, b, int(p), o[-MAX_OUTPUT:], now) for c, b, p, o in results])
+			extra = self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0] - self.max_size
+			if extra > 0:
+				self.db.execute('DELETE FROM results WHERE (command, blob) IN (SELECT command, blob FROM results ORDER BY used LIMIT ?)', (extra,))
+	def close(self):
+		self.db.close()
+
+def configured_checks():
+	settings = {}
+	for entry in git_output('config', '-z', '--get-regexp', '^better-git-check\\.').split('\0'):
+		if '\n' not in entry: continue
+		key, value = entry.split('\n', 1)
+		## better-git-check.<name>.<setting>, the name may itself contain dots
+		name, setting = key[len('better-git-check.'):].rsplit('.', 1)
+		settings.setdefault(name, {})[setting] = value
+	return [Check(name, s['command'], s.get('files', '').split()) for name, s in settings.items() if len(s.get('command', '').strip()) > 0]
+def staged_changes():
+	## (path, blob hash) of the files added or modified in the index
+	return _changed_blobs(['diff', '--cached'])
+def unpushed_changes(tip, remote_tip=None):
+	## (path, blob hash) of the files changed by tip since it branched from remote_tip, or, without
+	## remote_tip, by the commits of tip that are not on any remote branch
+	if remote_tip is not None:
+		return _changed_blobs(['diff', '%s...%s' % (remote_tip, tip)])
+	o = git_output('log', '-z', '--format=', '--name-only', '--no-renames', tip, '--not', '--remotes')
+	paths = list(dict.fromkeys(f.strip('\n') for f in o.split('\0') if len(f.strip('\n')) > 0))
+	if len(paths) == 0: return []
+	## the version at the tip, files deleted since are left out
+	changes = []
+	for entry in git_output('ls-tree', '-r', '-z', '--full-tree', tip, '--', *paths).split('\0'):
+		if '\t' not in entry: continue
+		info, f = entry.split('\t', 1)
+		mode, _, blob = info.split(' ')
+		if mode in ('100644', '100755'): changes.append((f, blob))
+	return changes
+def run_checks(changes, show_progress=True):
+	## runs the configured checks on changes (from staged_changes() or unpushed_changes()) and prints the
+	## failures. The files must be in the working tree as they are in changes. Returns True if all passed.
+	checks = configured_checks()
+	if len(checks) == 0 or len(changes) == 0: return True
+	refs = ref_snapshot()
+	cache = CheckCache(path.join(refs.dir.common_dir, CACHE_FILE), _config_int('better-git.checkcachesize', DEFAULT_CACHE_SIZE))
+	try:
+		failures = []
+		todo = []
+		hits = []
+		for check in checks:
+			for f, blob in changes:
+				if not check.applies_to(f): continue
+				cached = cache.get(check.command, blob)
+				if cached is None:
+					todo.append((check, f, blob))
+					continue
+				hits.append((check.command, blob))
+				if not cached[0]: failures.append((check, f, cached[1]))
+		cache.touch_many(hits)
+		if len(todo) > 0:
+			results = _run_all(refs.dir.work_tree, todo, _config_int('better-git.checkjobs', os.cpu_count() or 4), show_progress)
+			cache.put_many([(check.command, blob, passed, output) for (check, f, blob), (passed, output) in zip(todo, results)])
+			failures += [(check, f, output) for (check, f, _), (passed, output) in zip(todo, results) if not passed]
+	finally:
+		cache.close()
+	for check, f, output in failures:
+		print('Check %s failed for %s:' % (check.name, f))
+		if len(output.strip()) > 0: print(output.rstrip())
+	if len(failures) > 0:
+		print('%s checks failed' % len(failures))
+	return len(failures) == 0
+
+def _run_all(work_tree, todo, jobs, show_progress):
+	## runs each (check, path, blob) in todo, returns their (passed, output) in the same order
+	from concurrent.futures import ThreadPoolExecutor, as_completed
+	results = [None] * len(todo)
+	## each worker thread just waits for its check process, so the checks themselves run in parallel
+	with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+		futures = {pool.submit(_run_one, work_tree, check.command, f): i for i, (check, f, _) in enumerate(todo)}
+		for done, future in enumerate(as_completed(futures), 1):
+			results[futures[future]] = future.result()
+			if show_progress:
+				print('\rRunning checks: %s of %s' % (done, len(todo)), end='', file=sys.stderr, flush=True)
+	if show_progress: print('\r' + ' ' * 40 + '\r', end='', file=sys.stderr, flush=True)
+	return results
+def _run_one(work_tree, command, filename):
+	try:
+		p = Popen('%s %s' % (command, shlex.quote(filename)), shell=True, cwd=work_tree, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, close_fds=True)
+		o, _ = p.communicate()
+	except OSError as e:
+		return False, str(e)
+	return p.returncode == 0, o.decode('utf8', errors='replace')
+def _changed_blobs(diff_args):
+	## parses `git diff --raw -z`: ":old_mode new_mode old_blob new_blob status\0path\0" for each file
+	fields = git_output(*(diff_args[:1] + ['--raw', '-z', '--no-abbrev', '--no-renames', '--diff-filter=d'] + diff_args[1:])).split('\0')
+	changes = []
+	for info, f in zip(fields[0::2], fields[1::2]):
+		parts = info.split(' ')
+		## regular files only, not symlinks or submodules
+		if len(parts) == 5 and parts[1] in ('100644', '100755'): changes.append((f, parts[3]))
+	return changes
+def _config_int(name, default):
+	try:
+		return int(git_output('config', '--type=int', '--get', name).strip())
+	except ValueError:
+		return default
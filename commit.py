@@ -3,18 +3,41 @@
 # Copyright 2021 Christopher C. Hall
 # Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
 # https://creativecommons.org/licenses/by/4.0/
-from subprocess import call, Popen, PIPE, STDOUT
+from subprocess import PIPE, STDOUT
 import os, sys, re
 from os import path
+from core import run, confirm, ask_for_text
+from gittrace import user_input
+from status import scan_status, scan_staged
+from stager import write_changed_objects
+from checks import run_checks, staged_changes
 
 def main():
 	# show all changes
+	## the working tree is scanned once, before staging; the big files it lists are compressed in
+	## parallel first, git add then only has to check their hashes
+	before = scan_status()
+	if before is None:
+		print('Cannot commit, current working directory is not in a git repository!')
+		sys.exit(1)
+	write_changed_objects(before.work_tree_paths())
+	before.close()
 	run('git', 'add', '--all', fail_msg='Cannot commit, current working directory is not in a git repository!')
-	run('git', 'status', '-uall', '--porcelain')
+	## now everything is staged, so the changes can be read from the index alone; they are shown again for
+	## the final confirmation
+	changes = scan_staged()
+	if changes is None:
+		print('Error: failed to get status of the working directory')
+		sys.exit(1)
+	collapsed = changes.print_changes()
 	# ask user to confirm
-	if not confirm('Commit all file changes?'):
+	if not confirm_changes(changes, collapsed, 'Commit all file changes?'):
 		run('git', 'reset')
-		exit(1)
+		sys.exit(1)
+	# run the configured checks on the changed files
+	if not run_checks(staged_changes()) and not confirm('Commit anyway?'):
+		run('git', 'reset')
+		sys.exit(1)
 	# ask for commit message
 	commit_msg_lines = []
 	print('Enter commit message: (hit enter twice to finish message)')
@@ -24,71 +47,36 @@ def main():
 	msg = '\n'.join(commit_msg_lines)
 	if len(msg.strip()) == 0:
 		print('Empty messages are not allowed!')
-		exit(1)
+		sys.exit(1)
 	print()
 	print('Changed files:')
-	run('git', 'status', '-uall', '--porcelain')
+	changes.print_changes()
 	print()
 	print('Commit message:')
 	print(msg)
 	print()
-	if not confirm('Confirm?'):
+	if not confirm_changes(changes, collapsed, 'Confirm?'):
 		run('git', 'reset')
-		exit(1)
+		sys.exit(1)
 	# run the commit command
 	run('git', 'commit', '-m', msg)
 	# Done!
 	print('Done!')
 #
-def ask_for_text(msg, **kwargs):
-	print("%s: " % msg, **kwargs)
-	return input()
-def confirm(msg):
+def confirm_changes(changes, collapsed, msg):
+	## like confirm(), but if only the per-directory summary was shown, the full list can be asked for
+	if not collapsed:
+		return confirm(msg)
 	while True:
-		r = input('%s [y/n]: ' % msg).strip().lower()
+		r = user_input('%s [y/n, l to list all files]: ' % msg).strip().lower()
 		if r == 'y' or r == 'yes':
 			return True
 		elif r == 'n' or r == 'no':
 			return False
+		elif r == 'l' or r == 'list':
+			changes.print_all()
 		else:
 			continue
-def choose_from(msg, options_list):
-	while True:
-		try:
-			print(msg)
-			num = 1
-			for opt in options_list:
-				print('%s:\t%s' % (num, opt))
-				num += 1
-			r = input('Enter number: ')
-			i = int(r)-1
-			return i, options_list[i]
-		except ValueError:
-			print('Not a number, try again.')
-		except IndexError:
-			print('Not a valid option, try again.')
-def run(command, *args, fail_msg=None, capture_stdout=False):
-	args = list(args) # convert tuple to list
-	if fail_msg == None:
-		fail_msg = "Error: non-zero exit code returned by %s %s" % (command," ".join(args))
-	if capture_stdout == False:
-		exit_code = call([command]+args)
-		ret_val = None
-	else:
-		p = Popen([command]+args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		o, e = p.communicate()
-		if e is not None and len(e) > 0: print(e.decode('utf8'), file=sys.stderr)
-		ret_val = o.decode('utf8')
-		exit_code = p.returncode
-	if exit_code != 0:
-		print(fail_msg)
-		exit(1)
-	return ret_val
-def test_run(command, *args):
-	args = list(args)
-	p = Popen([command] + args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-	exit_code = p.wait()
-	return exit_code == 0
 #
 if __name__ == '__main__':
 	main()
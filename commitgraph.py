@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Pure-Python reader for git's commit-graph files (objects/info/commit-graph and the
+## objects/info/commit-graphs/ chain). The files are mmap'd and read in place with struct.unpack_from,
+## so looking up a commit, its parents, generation number, or commit date never spawns git.
+## See https://git-scm.com/docs/commit-graph-format for the file format.
+import os, mmap, struct, heapq
+from os import path
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+class GraphLayer:
+	## one commit-graph file
+	def __init__(self, filename):
+		with open(filename, 'rb') as fin:
+			self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+		mm = self.mm
+		if mm[0:4] != b'CGPH' or mm[4] != 1:
+			self.mm.close()
+			raise ValueError('%s is not a version 1 commit-graph file' % filename)
+		self.hash_len = 20 if mm[5] == 1 else 32
+		num_chunks = mm[6]
+		self.chunks = {}
+		for i in range(num_chunks):
+			chunk_id, offset = struct.unpack_from('>4sQ', mm, 8 + 12*i)
+			self.chunks[chunk_id] = offset
+		if b'OIDF' not in self.chunks or b'OIDL' not in self.chunks or b'CDAT' not in self.chunks:
+			self.mm.close()
+			raise ValueError('%s is missing a required chunk' % filename)
+		self.fanout = self.chunks[b'OIDF']
+		self.oid_lookup = self.chunks[b'OIDL']
+		self.commit_data = self.chunks[b'CDAT']
+		self.extra_edges = self.chunks.get(b'EDGE')
+		self.count = struct.unpack_from('>I', mm, self.fanout + 4*255)[0]
+		self.base_count = 0 # number of commits in the layers below this one, set by CommitGraph
+	def find(self, oid):
+		## binary search of the OID lookup chunk, narrowed by the fan-out table; returns local index or None
+		first = oid[0]
+		lo = 0 if first == 0 else struct.unpack_from('>I', self.mm, self.fanout + 4*(first-1))[0]
+		hi = struct.unpack_from('>I', self.mm, self.fanout + 4*first)[0]
+		h = self.hash_len
+		while lo < hi:
+			mid = (lo + hi) // 2
+			start = self.oid_lookup + mid*h
+			candidate = self.mm[start:start+h]
+			if candidate == oid:
+				return mid
+			elif candidate < oid:
+				lo = mid + 1
+			else:
+				hi = mid
+		return None
+	def oid(self, i):
+		start = self.oid_lookup + i*self.hash_len
+		return self.mm[start:start+self.hash_len]
+	def data(self, i):
+		## returns (parent 1, parent 2, generation, commit time) from the commit data chunk
+		p1, p2, gen_hi, time_lo = struct.unpack_from('>IIII', self.mm, self.commit_data + i*(self.hash_len+16) + self.hash_len)
+		generation = gen_hi >> 2
+		commit_time = ((gen_hi & 0x3) << 32) | time_lo
+		return p1, p2, generation, commit_time
+	def edge(self, i):
+		return struct.unpack_from('>I', self.mm, self.extra_edges + 4*i)[0]
+	def close(self):
+		self.mm.close()
+
+class CommitGraph:
+	## a stack of commit-graph layers; positions are global, counting up from the base layer
+	def __init__(self, layers):
+		self.layers = layers
+		total = 0
+		for layer in layers:
+			layer.base_count = total
+			total += layer.count
+		self.count = total
+	@staticmethod
+	def open(objects_dir):
+		## returns a CommitGraph for the given objects directory, or None if the repository has no commit-graph
+		single = path.join(objects_dir, 'info', 'commit-graph')
+		chain_dir = path.join(objects_dir, 'info', 'commit-graphs')
+		chain_file = path.join(chain_dir, 'commit-graph-chain')
+		try:
+			if path.isfile(single):
+				return CommitGraph([GraphLayer(single)])
+			if path.isfile(chain_file):
+				with open(chain_file, 'r') as fin:
+					hashes = [x.strip() for x in fin.read().split('\n') if len(x.strip()) > 0]
+				layers = []
+				for h in hashes:
+					layers.append(GraphLayer(path.join(chain_dir, 'graph-%s.graph' % h)))
+				return CommitGraph(layers) if len(layers) > 0 else None
+		except (OSError, ValueError):
+			pass
+		return None
+	def __len__(self):
+		return self.count
+	def _layer(self, pos):
+		for layer in reversed(self.layers):
+			if pos >= layer.base_count:
+				return layer, pos - layer.base_count
+		raise IndexError(pos)
+	def position(self, oid_hex):
+		## returns the graph position of a commit, or None if the commit is not in the graph
+		try:
+			oid = bytes.fromhex(oid_hex)
+		except ValueError:
+			return None
+		for layer in self.layers:
+			i = layer.find(oid)
+			if i is not None:
+				return layer.base_count + i
+		return None
+	def oid(self, pos):
+		layer, i = self._layer(pos)
+		return layer.oid(i).hex()
+	def parents(self, pos):
+		layer, i = self._layer(pos)
+		p1, p2, _, _ = layer.data(i)
+		parents = []
+		if p1 != GRAPH_PARENT_NONE: parents.append(p1)
+		if p2 == GRAPH_PARENT_NONE:
+			return parents
+		if p2 & GRAPH_EXTRA_EDGES == 0:
+			parents.append(p2)
+			return parents
+		## octopus merge: the rest of the parents are listed in the extra edges chunk
+		e = p2 & ~GRAPH_EXTRA_EDGES
+		while True:
+			edge = layer.edge(e)
+			parents.append(edge & ~GRAPH_LAST_EDGE)
+			if edge & GRAPH_LAST_EDGE: break
+			e += 1
+		return parents
+	def generation(self, pos):
+		## topological level: 1 for root commits, otherwise 1 + the largest generation of the parents
+		layer, i = self._layer(pos)
+		return layer.data(i)[2]
+	def commit_time(self, pos):
+		layer, i = self._layer(pos)
+		return layer.data(i)[3]
+	def walk(self, oid_hex):
+		## yields graph positions reachable from the given commit, newest commit date first (the order of
+		## `git log`), or returns None if the commit is not in the graph
+		start = self.position(oid_hex)
+		if start is None: return None
+		return self._walk(start)
+	def _walk(self, start):
+		seen = bytearray(self.count)
+		seen[start] = 1
+		queue = [(-self.commit_time(start), 0, start)]
+		order = 1 # tie-breaker so commits with equal dates come out in the order they were found
+		while len(queue) > 0:
+			_, _, pos = heapq.heappop(queue)
+			yield pos
+			for parent in self.parents(pos):
+				if not seen[parent]:
+					seen[parent] = 1
+					heapq.heappush(queue, (-self.commit_time(parent), order, parent))
+					order += 1
+	def count_reachable(self, oid_hex):
+		## number of commits reachable from the given commit (what `git rev-list --count` prints), or None
+		start = self.position(oid_hex)
+		if start is None: return None
+		seen = bytearray(self.count)
+		seen[start] = 1
+		stack = [start]
+		total = 0
+		while len(stack) > 0:
+			pos = stack.pop()
+			total += 1
+			for parent in self.parents(pos):
+				if not seen[parent]:
+					seen[parent] = 1
+					stack.append(parent)
+		return total
+	def count_newer_than(self, oid_hex, timestamp):
+		## number of commits `git log` lists before the first commit dated before timestamp, or None
+		walk = self.walk(oid_hex)
+		if walk is None: return None
+		skip = 0
+		for pos in walk:
+			if self.commit_time(pos) < timestamp: break
+			skip += 1
+		return skip
+	def close(self):
+		for layer in self.layers: layer.close()
+		self.layers = []
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Searchable index of the commit history, kept in .git/better-git-commit-index.sqlite. Each commit is
+## stored once, with the words of its message and author as postings (word -> commits), and each branch
+## remembers the tip it was last indexed at. When a branch moves, only the commits since that tip are
+## read from git log, so searching never re-reads the whole history (unless the branch was rewritten).
+##
+## Search queries are words to find in the commit message (the start of a word is enough, eg "fix"
+## finds "fixes"), plus any of:
+##   author:name          author name or email starts with name
+##   since:YYYY-MM-DD     committed on or after this date
+##   until:YYYY-MM-DD     committed on or before this date
+##   a hash prefix        (4 or more hex digits) matches commits whose hash starts with it
+from subprocess import PIPE, DEVNULL
+import os, sys, re
+from os import path
+from gittrace import Popen
+from core import test_run
+
+INDEX_FILE = 'better-git-commit-index.sqlite'
+WORD_PATTERN = re.compile('\\w+')
+HASH_PATTERN = re.compile('^[0-9a-f]{4,40}$')
+MAX_WORD_LENGTH = 40
+## fields of each commit, separated by \x1f (commits are separated by \0 with -z); the dates are the
+## committer dates, like in branch.py's log pages
+LOG_FORMAT = '%H%x1f%ct%x1f%cd%x1f%an%x1f%ae%x1f%s%x1f%b'
+## kept in the database's user_version, an index written with another version is made again from scratch
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS commits (id INTEGER PRIMARY KEY, hash TEXT UNIQUE NOT NULL, time INTEGER,
+	date TEXT, author TEXT, subject TEXT);
+CREATE INDEX IF NOT EXISTS commits_time ON commits (time);
+CREATE TABLE IF NOT EXISTS words (word TEXT, commit_id INTEGER, PRIMARY KEY (word, commit_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS branch_commits (branch TEXT, commit_id INTEGER, PRIMARY KEY (branch, commit_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tips (branch TEXT PRIMARY KEY, hash TEXT);
+'''
+## version 1 stored the author dates
+DROP_TABLES = '''
+DROP TABLE IF EXISTS commits;
+DROP TABLE IF EXISTS words;
+DROP TABLE IF EXISTS branch_commits;
+DROP TABLE IF EXISTS tips;
+'''
+
+class CommitIndex:
+	def __init__(self, filename):
+		import sqlite3
+		self.db = sqlite3.connect(filename)
+		if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+			self.db.executescript(DROP_TABLES)
+			self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+		self.db.executescript(SCHEMA)
+	def update(self, branch, tip, show_progress=True):
+		## indexes the commits added to branch since it was last indexed, returns how many were read
+		row = self.db.execute('SELECT hash FROM tips WHERE branch = ?', (branch,)).fetchone()
+		old_tip = None if row is None else row[0]
+		if old_tip == tip:
+			return 0
+		with self.db:
+			if old_tip is not None and test_run('git', 'merge-base', '--is-ancestor', old_tip, tip):
+				exclude = [old_tip]
+			else:
+				## new branch, or the branch was rewritten (eg rebased), so index it from scratch
+				self.db.execute('DELETE FROM branch_commits WHERE branch = ?', (branch,))
+				exclude = []
+			count = 0
+			batch = []
+			for commit in _log(tip, exclude):
+				batch.append(commit)
+				if len(batch) >= 1000:
+					count += self._add(branch, batch)
+					batch = []
+					if show_progress:
+						print('\rIndexing history of %s: %s commits' % (branch, count), end='', file=sys.stderr, flush=True)
+			count += self._add(branch, batch)
+			if show_progress and count >= 1000:
+				print('\r' + ' ' * 60 + '\r', end='', file=sys.stderr, flush=True)
+			self.db.execute('INSERT OR REPLACE INTO tips (branch, hash) VALUES (?, ?)', (branch, tip))
+		return count
+	def _add(self, branch, commits):
+		for c in commits:
+			self.db.execute('INSERT OR IGNORE INTO commits (hash, time, date, author, subject) VALUES (?, ?, ?, ?, ?)',
+							(c['hash'], c['time'], c['date'], c['author'], c['subject']))
+		## look up the ids in batches, commits already indexed from another branch keep their words
+		ids = {}
+		for i in range(0, len(commits), 500):
+			chunk = [c['hash'] for c in commits[i:i+500]]
+			ids.update(self.db.execute('SELECT hash, id FROM commits WHERE hash IN (%s)' % ','.join('?' * len(chunk)), chunk))
+		self.db.executemany('INSERT OR IGNORE INTO words (word, commit_id) VALUES (?, ?)',
+							[(w, ids[c['hash']]) for c in commits for w in c['words']])
+		self.db.executemany('INSERT OR IGNORE INTO branch_commits (branch, commit_id) VALUES (?, ?)',
+							[(branch, ids[c['hash']]) for c in commits])
+		return len(commits)
+	def search(self, branch, query, limit=20):
+		## returns up to limit matching commits of branch, newest first, as '%H  %cd  %an  %s' lines (the layout of branch.py's log pages)
+		words, authors, since, until, hashes = parse_query(query)
+		conditions = ['c.id IN (SELECT commit_id FROM branch_commits WHERE branch = ?)']
+		args = [branch]
+		for w in words:
+			condition = 'c.id IN (SELECT commit_id FROM words WHERE word >= ? AND word < ?)'
+			w_args = [w, w + '\U0010ffff']
+			if w in hashes:
+				## could be a word or the start of a hash
+				condition = '(%s OR (c.hash >= ? AND c.hash < ?))' % condition
+				w_args += [w, w + '\U0010ffff']
+			conditions.append(condition)
+			args += w_args
+		for a in authors:
+			conditions.append('c.id IN (SELECT commit_id FROM words WHERE word >= ? AND word < ?)')
+			args += ['author:' + a, 'author:' + a + '\U0010ffff']
+		if since is not None:
+			conditions.append('c.time >= ?')
+			args.append(since)
+		if until is not None:
+			conditions.append('c.time < ?')
+			args.append(until)
+		rows = self.db.execute('SELECT c.hash, c.date, c.author, c.subject FROM commits c WHERE %s ORDER BY c.time DESC LIMIT ?'
+							   % ' AND '.join(conditions), args + [limit])
+		return ['%s  %s  %s  %s' % row for row in rows]
+	def close(self):
+		self.db.close()
+
+def parse_query(query):
+	## returns (words, authors, since timestamp, until timestamp, hash prefixes), raises ValueError for bad dates
+	from datetime import datetime, timedelta
+	words, authors, hashes = [], [], []
+	since = until = None
+	for term in query.split():
+		key, _, value = term.partition(':')
+		if key == 'author' and len(value) > 0:
+			authors += _words(value)
+		elif key == 'since' and len(value) > 0:
+			since = int(datetime.strptime(value, '%Y-%m-%d').timestamp())
+		elif key == 'until' and len(value) > 0:
+			until = int((datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)).timestamp())
+		else:
+			if HASH_PATTERN.match(term.lower()): hashes.append(term.lower())
+			words += _words(term)
+	return words, authors, since, until, hashes
+def open_commit_index(git_dir):
+	## the commit index of the repository, or None if this Python has no sqlite3 module
+	try:
+		return CommitIndex(path.join(git_dir, INDEX_FILE))
+	except ImportError:
+		return None
+
+def _words(text):
+	return [w for w in WORD_PATTERN.findall(text.lower()) if len(w) <= MAX_WORD_LENGTH]
+def _log(tip, exclude):
+	## yields the commits reachable from tip but not from any of exclude, as dicts
+	p = Popen(['git', '--no-pager', 'log', '-z', '--date=short', '--format=' + LOG_FORMAT, tip] + ['^' + x for x in exclude] + ['--'],
+			  stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	remainder = b''
+	while len(chunk := p.stdout.read(1 << 16)) > 0:
+		records = (remainder + chunk).split(b'\0')
+		remainder = records.pop()
+		for record in records: yield _parse(record)
+	if len(remainder) > 0: yield _parse(remainder)
+	if p.wait() != 0:
+		raise RuntimeError('failed to read history of %s' % tip)
+def _parse(record):
+	h, t, date, name, email, subject, body = record.decode('utf8', errors='replace').split('\x1f', 6)
+	words = set(_words(subject + ' ' + body))
+	words.update('author:' + w for w in _words(name + ' ' + email))
+	return {'hash': h, 'time': int(t), 'date': date, 'author': name, 'subject': subject, 'words': words}
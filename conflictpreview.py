@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Read-only preview of the conflicts a merge would have. `git merge-tree --write-tree` (git 2.38+) merges
+## in memory and writes the merged files, conflict markers and all, as objects, so the conflicting hunks
+## can be counted and shown without touching the index or the working tree. The files are scanned in
+## parallel, one line at a time, so only the per-file counts are ever kept in memory.
+from subprocess import PIPE, DEVNULL
+import os, sys
+from gittrace import Popen
+
+CONFLICT_START = b'<<<<<<<'
+CONFLICT_END = b'>>>>>>>'
+CONFLICT_SEPARATOR = (b'=======', b'|||||||')
+
+class ConflictFile:
+	def __init__(self, file_path, stages):
+		self.path = file_path
+		self.stages = stages # the stages (1 = common ancestor, 2 = merge-to, 3 = merge-from) the file has
+		self.hunks = 0
+		self.conflict_lines = 0
+		self.total_lines = 0
+	def kind(self):
+		if 2 not in self.stages: return 'deleted in merge-to branch'
+		if 3 not in self.stages: return 'deleted in merge-from branch'
+		if 1 not in self.stages: return 'added in both branches'
+		if self.hunks == 0: return 'binary or not mergeable'
+		return 'content'
+	def severity(self):
+		## number of lines someone has to look at: the conflicting lines, or the whole file if it can't be merged line by line
+		return self.conflict_lines if self.hunks > 0 else self.total_lines
+	def describe(self):
+		if self.hunks > 0:
+			return '%s hunk%s, %s conflicting lines' % (self.hunks, '' if self.hunks == 1 else 's', self.conflict_lines)
+		return '%s (%s lines)' % (self.kind(), self.total_lines)
+
+class ConflictPreview:
+	def __init__(self, tree, files):
+		self.tree = tree # the merged tree, with conflict markers in the conflicting files
+		self.files = files # ConflictFile list, most severe first
+	def print_summary(self, max_rows=40):
+		## returns True if some files were left out
+		print('%s files with merge conflicts (most conflicting lines first):' % len(self.files))
+		for f in self.files[:max_rows]:
+			print('\t%s: %s' % (f.path, f.describe()))
+		if len(self.files) > max_rows:
+			print('\t... and %s more' % (len(self.files) - max_rows))
+			return True
+		return False
+	def print_all(self):
+		for f in self.files: print('\t%s: %s' % (f.path, f.describe()))
+	def print_hunks(self, conflict_file, context=3):
+		## streams the conflicting hunks of one file (with a few lines of context), numbered by line
+		p = _cat_merged_file(self.tree, conflict_file.path)
+		before = [] # the last few lines before a hunk
+		in_hunk = False
+		after = 0 # context lines still to print after a hunk
+		last_printed = 0 # number of the last line printed
+		for num, ln in enumerate(p.stdout, 1):
+			text = '%6s  %s' % (num, ln.decode('utf8', errors='replace').rstrip('\r\n'))
+			if ln.startswith(CONFLICT_START):
+				## only when lines were left out between the last line printed and this hunk's context
+				if num - len(before) > last_printed + 1: print('   ...')
+				for b in before: print(b)
+				before = []
+				in_hunk = True
+			if in_hunk or after > 0:
+				print(text)
+				last_printed = num
+				after -= 0 if in_hunk else 1
+			else:
+				before = (before + [text])[-context:]
+			if in_hunk and ln.startswith(CONFLICT_END):
+				in_hunk = False
+				after = context
+		p.wait()
+
+def preview_conflicts(merge_from, merge_to, show_progress=True):
+	## returns a ConflictPreview of merging merge_from into merge_to (with no files if the merge is clean),
+	## or None if this version of git can't merge in memory
+	p = Popen(['git', 'merge-tree', '--write-tree', '--no-messages', '-z', merge_to, merge_from],
+			  stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	if p.returncode not in (0, 1):
+		return None
+	## output is the merged tree hash, then "<mode> <object> <stage>\t<path>" for each conflicting stage, all NUL-terminated
+	fields = [x for x in o.decode('utf8').split('\0') if len(x) > 0]
+	if len(fields) == 0 or (p.returncode == 1 and len(fields) == 1):
+		return None
+	stages = {}
+	for entry in fields[1:]:
+		info, _, file_path = entry.partition('\t')
+		stages.setdefault(file_path, set()).add(int(info.split(' ')[2]))
+	files = [ConflictFile(f, s) for f, s in stages.items()]
+	from concurrent.futures import ThreadPoolExecutor
+	done = 0
+	with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+		for _ in pool.map(lambda f: _scan(fields[0], f), files):
+			done += 1
+			if show_progress and len(files) > 10:
+				print('\rScanning conflicts: %s/%s files' % (done, len(files)), end='', file=sys.stderr, flush=True)
+	if show_progress and len(files) > 10:
+		print('\r' + ' ' * 50 + '\r', end='', file=sys.stderr, flush=True)
+	files.sort(key=lambda f: (-f.severity(), f.path))
+	return ConflictPreview(fields[0], files)
+
+def _scan(tree, conflict_file):
+	p = _cat_merged_file(tree, conflict_file.path)
+	in_hunk = False
+	for ln in p.stdout:
+		conflict_file.total_lines += 1
+		if ln.startswith(CONFLICT_START):
+			conflict_file.hunks += 1
+			in_hunk = True
+		elif in_hunk and ln.startswith(CONFLICT_END):
+			in_hunk = False
+		elif in_hunk and not ln.startswith(CONFLICT_SEPARATOR):
+			conflict_file.conflict_lines += 1
+	p.wait()
+def _cat_merged_file(tree, file_path):
+	## the file as merge-tree wrote it (nothing, if the merge deleted it)
+	return Popen(['git', 'cat-file', 'blob', '%s:%s' % (tree, file_path)], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Helpers shared by all the better-git commands: asking the user questions and running git.
+from subprocess import PIPE, STDOUT, DEVNULL
+import sys
+from gittrace import call, Popen, user_input
+
+MAX_MENU_SIZE = 40
+MAX_NOTE_COLUMN = 40
+
+def ask_for_text(msg, **kwargs):
+	print("%s: " % msg, **kwargs)
+	return user_input()
+def confirm(msg):
+	while True:
+		r = user_input('%s [y/n]: ' % msg).strip().lower()
+		if r == 'y' or r == 'yes':
+			return True
+		elif r == 'n' or r == 'no':
+			return False
+		else:
+			continue
+def choose_from(msg, options_list, keep_listed=0, notes=None):
+	## Numbered menu. Menus longer than MAX_MENU_SIZE are unusable (eg thousands of branches), so then
+	## the option is typed instead, with completion; the first keep_listed options (eg "(new branch)")
+	## are still listed with their numbers. notes is an optional dict of option -> text shown after it
+	## (eg from branchnotes.branch_notes()).
+	if len(options_list) > MAX_MENU_SIZE:
+		return choose_by_name(msg, options_list, keep_listed, notes)
+	width = _note_column(options_list, notes)
+	while True:
+		try:
+			print(msg)
+			num = 1
+			for opt in options_list:
+				print(_option_line(num, opt, notes, width))
+				num += 1
+			r = user_input('Enter number: ')
+			if r in options_list and not r.strip().isdigit():
+				## the option itself can be typed instead of its number (used by multirepo.py plans)
+				return options_list.index(r), r
+			i = int(r)-1
+			return i, options_list[i]
+		except ValueError:
+			print('Not a number, try again.')
+		except IndexError:
+			print('Not a valid option, try again.')
+def choose_by_name(msg, options_list, keep_listed=0, notes=None):
+	## Asks for an option by name: Tab completes it (where readline is available), and typing the start
+	## of a name lists the options that start with it. Numbers still work, as in choose_from.
+	from refindex import NameIndex
+	index = NameIndex(options_list)
+	print(msg)
+	width = _note_column(options_list[:keep_listed], notes)
+	for i in range(keep_listed): print(_option_line(i+1, options_list[i], notes, width))
+	print('(%s options: type a name, Tab completes it; type the start of a name to list the matches)' % len(options_list))
+	with _completion(index):
+		while True:
+			r = user_input('Enter name or number: ').strip()
+			if r in index:
+				i = index.position(r)
+				return i, options_list[i]
+			if r.isdigit() and 0 < int(r) <= len(options_list):
+				return int(r)-1, options_list[int(r)-1]
+			matches = index.complete(r, limit=MAX_MENU_SIZE)
+			if len(matches) == 0:
+				print('No option starts with "%s", try again.' % r)
+				continue
+			width = _note_column(matches, notes)
+			for m in matches: print(_option_line(index.position(m)+1, m, notes, width))
+			if (more := index.count(r) - len(matches)) > 0:
+				print('... and %s more, type more of the name' % more)
+def _note_column(options, notes):
+	## width to pad the options to, so the notes line up (very long names just push their note along)
+	if notes is None or len(options) == 0: return 0
+	return min(max(len(opt) for opt in options), MAX_NOTE_COLUMN)
+def _option_line(num, opt, notes, width):
+	if notes is None or opt not in notes: return '%s:\t%s' % (num, opt)
+	return '%s:\t%-*s  %s' % (num, width, opt, notes[opt])
+class _completion:
+	## Tab completion from a NameIndex while asking for a name (only when typing into a terminal)
+	def __init__(self, index):
+		self.index = index
+		self.readline = None
+	def __enter__(self):
+		if not sys.stdin.isatty(): return self
+		try:
+			import readline
+		except ImportError:
+			return self # eg Windows
+		self.readline = readline
+		self.old_completer = readline.get_completer()
+		self.old_delims = readline.get_completer_delims()
+		readline.set_completer(self.complete)
+		readline.set_completer_delims(' \t\n') # branch names contain '/', '-' and '.'
+		readline.parse_and_bind('tab: complete')
+		return self
+	def complete(self, text, state):
+		if state == 0: self.matches = self.index.complete(text, limit=1000)
+		return self.matches[state] if state < len(self.matches) else None
+	def __exit__(self, *exc):
+		if self.readline is not None:
+			self.readline.set_completer(self.old_completer)
+			self.readline.set_completer_delims(self.old_delims)
+		return False
+def run(command, *args, fail_msg=None, capture_stdout=False):
+	args = list(args) # convert tuple to list
+	if fail_msg == None:
+		fail_msg = "Error: non-zero exit code returned by %s %s" % (command," ".join(args))
+	if capture_stdout == False:
+		exit_code = call([command]+args)
+		ret_val = None
+	else:
+		p = Popen([command]+args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
+		o, e = p.communicate()
+		if e is not None and len(e) > 0: print(e.decode('utf8'), file=sys.stderr)
+		ret_val = o.decode('utf8')
+		exit_code = p.returncode
+	if exit_code != 0:
+		print(fail_msg)
+		sys.exit(1)
+	return ret_val
+def git_output(*args):
+	## what a git command prints (its errors are dropped), '' if it fails. Unlike run(), never exits.
+	p = Popen(['git'] + list(args), stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	return o.decode('utf8')
+def test_run(command, *args, hide_output=True):
+	args = list(args)
+	if hide_output:
+		p = Popen([command] + args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
+		exit_code = p.wait()
+	else:
+		exit_code = call([command] + args)
+	return exit_code == 0
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Asks the repository daemon (see repodaemon.py) for warm answers. Every function returns None when no
+## daemon is running for the repository (or it doesn't answer), and the caller then asks git itself,
+## so the commands work the same with or without the daemon. When there is no socket file, nothing
+## more than one stat call is spent.
+import os
+from os import path
+
+SOCKET_NAME = 'better-git-daemon.sock'
+## sockaddr_un paths are limited to about 100 bytes
+MAX_SOCKET_PATH = 100
+TIMEOUT = 5.0
+
+def socket_path(git_dir, name=SOCKET_NAME):
+	sock = path.join(git_dir, name)
+	if len(sock) <= MAX_SOCKET_PATH: return sock
+	import tempfile, hashlib
+	return path.join(tempfile.gettempdir(), '%s-%s' % (hashlib.sha1(path.abspath(git_dir).encode('utf8')).hexdigest()[:16], name))
+def daemon_request(git_dir, op, socket_name=SOCKET_NAME, **args):
+	## sends one request, returns the reply (a dict), or None
+	sock = socket_path(git_dir, socket_name)
+	if not path.exists(sock): return None
+	import socket, json
+	if not hasattr(socket, 'AF_UNIX'): return None
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+			s.settimeout(TIMEOUT)
+			s.connect(sock)
+			s.sendall(json.dumps(dict(args, op=op)).encode('utf8') + b'\n')
+			with s.makefile('rb') as fin:
+				reply = json.loads(fin.readline())
+	except (OSError, ValueError):
+		return None # daemon not running (a socket left behind by a crash) or not answering
+	if not isinstance(reply, dict) or 'error' in reply: return None
+	return reply
+def daemon_remotes():
+	## `git remote` from the daemon, or None
+	from refsnapshot import ref_snapshot
+	refs = ref_snapshot()
+	if refs is None: return None
+	reply = daemon_request(refs.dir.git_dir, 'remotes')
+	return None if reply is None else reply['remotes']
+def daemon_log_page(git_dir, tip, start, count):
+	## (exit code, log lines) of `git log --skip=start -n count tip` in LogPager's format, or None
+	reply = daemon_request(git_dir, 'log', tip=tip, start=start, count=count)
+	return None if reply is None else (reply['code'], reply['lines'])
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Fetch scheduler used instead of a blocking `git fetch --all`: remotes are fetched concurrently, a full
+## fetch is skipped if the last one (the mtime of FETCH_HEAD) is younger than the freshness TTL, and a
+## fetch can be narrowed to just the branches a command is about to use.
+## The TTL is set in seconds with `git config better-git.fetchttl <seconds>` (0 always fetches).
+from subprocess import PIPE, STDOUT, DEVNULL
+import os, sys, time
+from os import path
+from gittrace import Popen
+from core import git_output
+
+DEFAULT_FETCH_TTL = 60
+
+def fetch(refs=None, ttl=None):
+	## refs: list of remote-tracking branch names (eg 'origin/main') to fetch, or None to fetch everything.
+	## Returns True if git was asked to fetch, False if the previous fetch was still fresh.
+	remotes = _git_lines('remote')
+	if len(remotes) == 0:
+		return False
+	if refs is None:
+		if ttl is None: ttl = fetch_ttl()
+		if fetch_age() < ttl:
+			return False
+		jobs = [(r, None) for r in remotes]
+	else:
+		## group the branches by remote, so each remote is contacted once
+		## (remote names may contain '/', so match the longest remote name first)
+		by_remote = {}
+		for ref in refs:
+			for r in sorted(remotes, key=len, reverse=True):
+				if ref.startswith(r + '/'):
+					by_remote.setdefault(r, []).append(ref[len(r)+1:])
+					break
+		jobs = list(by_remote.items())
+		if len(jobs) == 0:
+			return False
+	from concurrent.futures import ThreadPoolExecutor, as_completed
+	done = 0
+	failed = []
+	_progress(done, jobs)
+	with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+		futures = {}
+		for remote, branches in jobs:
+			write_fetch_head = branches is None and remote == jobs[0][0]
+			futures[pool.submit(_fetch_one, remote, branches, write_fetch_head)] = remote
+		for future in as_completed(futures):
+			ok, output = future.result()
+			done += 1
+			_progress(done, jobs)
+			if not ok: failed.append((futures[future], output))
+	print()
+	for remote, output in failed:
+		print(output, file=sys.stderr)
+		print('Error: failed to fetch from remote %s' % remote)
+	if len(failed) > 0:
+		sys.exit(1)
+	return True
+def fetch_ttl():
+	value = ''.join(_git_lines('config', '--get', 'better-git.fetchttl'))
+	try:
+		return int(value)
+	except ValueError:
+		return DEFAULT_FETCH_TTL
+def fetch_age():
+	## seconds since the last full fetch, or infinity if there never was one
+	fetch_head = ''.join(_git_lines('rev-parse', '--git-path', 'FETCH_HEAD'))
+	try:
+		return time.time() - os.stat(fetch_head).st_mtime
+	except (OSError, ValueError):
+		return float('inf')
+def _fetch_one(remote, branches, write_fetch_head):
+	## branches=None fetches everything from the remote. Only one of the concurrent fetches may write
+	## FETCH_HEAD (they would overwrite each other), and a narrowed fetch must not write it at all, or it
+	## would look like a fresh full fetch.
+	args = ['git', 'fetch', '--quiet']
+	if not write_fetch_head: args.append('--no-write-fetch-head')
+	args.append(remote)
+	if branches is not None: args += branches
+	p = Popen(args, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, close_fds=True)
+	o, _ = p.communicate()
+	return p.returncode == 0, o.decode('utf8', errors='replace').strip()
+def _progress(done, jobs):
+	names = ', '.join(r for r, _ in jobs)
+	print('\rFetching from %s: %s/%s remotes done' % (names, done, len(jobs)), end='', flush=True)
+def _git_lines(*args):
+	return [x for x in git_output(*args).replace('\r', '').split('\n') if len(x) > 0]
@@ -3,13 +3,23 @@
 # Copyright 2021 Christopher C. Hall
 # Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
 # https://creativecommons.org/licenses/by/4.0/
-from subprocess import call, Popen, PIPE, STDOUT
+from subprocess import PIPE, STDOUT
 import os, sys, re
 from os import path
+from core import run, test_run, confirm, choose_from, ask_for_text
+from refsnapshot import ref_snapshot
+from refindex import ref_index
+from fetcher import fetch
+from mirrorcache import mirror_cache_enabled, dissociate_clones, prepare_mirror, record_clone, evict_mirrors
+from branchnotes import branch_notes
+
+## remotes with at least this many refs are assumed to be big enough to recommend a partial clone
+LARGE_REPO_REF_COUNT = 500
 
 def main():
 	# Check for presense of ".git" folder
 	## use dummy git command to check if in git repo
+	just_cloned = False
 	if not test_run('git', 'status'):
 		# not in a git repo, clone it
 		# Ask user for remote URL
@@ -18,13 +28,26 @@ def main():
 		if clone_dir.endswith('.git'): clone_dir = clone_dir[:-4]
 		if path.isdir(clone_dir):
 			print('Failed to clone git repository "%s": directory "%s" already exists' % (remote_url, clone_dir))
-			exit(1)
+			sys.exit(1)
+		# Ask how much of the repository to download
+		clone_args, sparse_dirs = clone_options(remote_url)
+		## borrow objects from the local mirror of this remote, if the mirror cache is turned on
+		mirror = prepare_mirror(remote_url) if mirror_cache_enabled() else None
+		if mirror is not None:
+			dissociate = dissociate_clones()
+			clone_args += ['--reference-if-able', mirror] + (['--dissociate'] if dissociate else [])
 		# Clone from remote URL
-		run('git', 'clone', remote_url, clone_dir,
+		run('git', 'clone', *clone_args, remote_url, clone_dir,
 			fail_msg='Failed to clone git repository "%s"' % remote_url, 
 			capture_stdout=False)
+		if mirror is not None:
+			record_clone(remote_url, path.abspath(clone_dir), dissociate)
+			for evicted in evict_mirrors(): print('Removed the unused local mirror of %s' % evicted)
 		# Change directory into the cloned repo folder
 		os.chdir(clone_dir)
+		just_cloned = True
+		if len(sparse_dirs) > 0:
+			run('git', 'sparse-checkout', 'set', '--cone', *sparse_dirs)
 		# Setup the local git repo (eg ask user for name and email)
 		run('git', 'config', 'credential.helper', 'cache')
 		username=ask_for_text('Enter your name on this project')
@@ -34,77 +57,73 @@ def main():
 		run('git', 'config', 'user.name', username)
 		run('git', 'config', 'user.email', username)
 	# Get list of remote branches
-	run('git', 'fetch', '--all')
-	this_branch = run('git', 'symbolic-ref', '--short', '-q', 'HEAD',
-		capture_stdout=True)
-	## for local branches, replace 'refs/remotes/' with 'refs/heads/'
-	branch_list = [x for x in run('git', 'for-each-ref', '--format', '%(refname:short)', 'refs/remotes/',
-		capture_stdout=True).replace('\r','').split('\n') if len(x) > 0] # necessary because git prints an extra new-line!
+	## (a fresh clone is already up to date, otherwise only fetch if the last fetch is stale)
+	fetched = just_cloned or fetch()
+	refs = ref_snapshot()
+	this_branch = refs.current_branch()
+	## for local branches, use refs.branches() instead
+	branch_list = refs.remote_branches()
 	# Ask user which branch to fork
 	print()
-	_, fork_src = choose_from('Which branch would you like to fork from?', branch_list)
+	_, fork_src = choose_from('Which branch would you like to fork from?', branch_list, notes=branch_notes(branch_list, remote=True))
 	fork_name = ''
 	while True:
 		fork_name = ask_for_text('Name of new local branch').strip()
 		# If local branch already exists, keep asking for a different name
-		if len(fork_name) > 0 and fork_name not in branch_list:
+		if len(fork_name) > 0 and fork_name not in ref_index().local:
 			break
 		else:
 			print('Error: Branch name "%s" is invalid or already exists. Try again.' % fork_name)
+	## make sure the chosen branch is up to date, even if the branch list came from an earlier fetch
+	## (unless the full fetch above just happened, then it is already up to date)
+	if not fetched: fetch([fork_src])
 	# Run "git checkout -b local_branch remote_branch" command
 	run('git', 'checkout', '-b', fork_name, fork_src)
 	# Done!
 	print('Done!')
 #
-def ask_for_text(msg, **kwargs):
-	print("%s: " % msg, **kwargs)
-	return input()
-def confirm(msg):
-	while True:
-		r = input('%s [y/n]: ' % msg).strip().lower()
-		if r == 'y' or r == 'yes':
-			return True
-		elif r == 'n' or r == 'no':
-			return False
-		else:
-			continue
-def choose_from(msg, options_list):
-	while True:
-		try:
-			print(msg)
-			num = 1
-			for opt in options_list:
-				print('%s:\t%s' % (num, opt))
-				num += 1
-			r = input('Enter number: ')
-			i = int(r)-1
-			return i, options_list[i]
-		except ValueError:
-			print('Not a number, try again.')
-		except IndexError:
-			print('Not a valid option, try again.')
-def run(command, *args, fail_msg=None, capture_stdout=False):
-	args = list(args) # convert tuple to list
-	if fail_msg == None:
-		fail_msg = "Error: non-zero exit code returned by %s %s" % (command," ".join(args))
-	if capture_stdout == False:
-		exit_code = call([command]+args)
-		ret_val = None
-	else:
-		p = Popen([command]+args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		o, e = p.communicate()
-		if e is not None and len(e) > 0: print(e.decode('utf8'), file=sys.stderr)
-		ret_val = o.decode('utf8')
-		exit_code = p.returncode
-	if exit_code != 0:
-		print(fail_msg)
-		exit(1)
-	return ret_val
-def test_run(command, *args):
-	args = list(args)
-	p = Popen([command] + args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-	exit_code = p.wait()
-	return exit_code == 0
+def clone_options(remote_url):
+	## asks the user how much of the remote repository to clone, returns (git clone arguments, sparse checkout folders)
+	## The size of a remote repository isn't known until it is downloaded, so the number of refs it has
+	## (from one quick ls-remote) is used as a hint of how big it is.
+	remote_refs = [x.split('\t')[1] for x in run('git', 'ls-remote', remote_url, capture_stdout=True,
+		fail_msg='Failed to connect to git repository "%s"' % remote_url).replace('\r', '').split('\n') if '\t' in x]
+	remote_branches = [x[len('refs/heads/'):] for x in remote_refs if x.startswith('refs/heads/')]
+	large_repo = len(remote_refs) >= LARGE_REPO_REF_COUNT
+	clone_types = ['full clone (all history and all files)',
+				   'blobless clone (all history, file contents are downloaded when needed)',
+				   'treeless clone (all commits, folders and file contents are downloaded when needed)',
+				   'shallow clone (only the most recent history)']
+	recommended = 1 if large_repo else 0
+	clone_types[recommended] += ' (recommended)'
+	print('The remote repository has %s branches and %s refs.' % (len(remote_branches), len(remote_refs)))
+	clone_type, _ = choose_from('What kind of clone do you want?', clone_types)
+	clone_args = []
+	if clone_type == 1:
+		clone_args.append('--filter=blob:none')
+	elif clone_type == 2:
+		clone_args.append('--filter=tree:0')
+	elif clone_type == 3:
+		while True:
+			depth = ask_for_text('Number of commits to download, or a date to download history since (YYYY-MM-DD)').strip()
+			if re.match('^\\d+$', depth) and int(depth) > 0:
+				clone_args.append('--depth=%s' % depth)
+				break
+			elif re.match('^\\d{4}-\\d{2}-\\d{2}$', depth):
+				clone_args.append('--shallow-since=%s' % depth)
+				break
+			print('Not a number or a date, try again.')
+	if len(remote_branches) > 1 and confirm('Only download one branch (the one you will fork from)?'):
+		_, clone_branch = choose_from('Which branch?', remote_branches)
+		clone_args += ['--single-branch', '--branch', clone_branch]
+	elif clone_type == 3:
+		## --depth implies --single-branch, but all branches are wanted
+		clone_args.append('--no-single-branch')
+	sparse_dirs = []
+	if confirm('Only check out some folders (sparse checkout)?'):
+		sparse_dirs = ask_for_text('Folders to check out (separated by spaces)').split()
+		if len(sparse_dirs) > 0: clone_args.append('--sparse')
+	return clone_args, sparse_dirs
 #
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## core.fsmonitor hook (protocol version 2) for Linux, so `git status` and `git add --all` only look at the
+## files that changed instead of checking every file in the working tree. A watcher process per
+## repository watches every folder of the working tree with inotify and keeps a journal of the paths
+## that changed. When git runs the hook, the hook asks the watcher (over a Unix socket in the git dir)
+## which paths changed since the token git got last time.
+##
+## usage: python3 fsmonitor.py install      (in the repository: sets core.fsmonitor and starts the watcher)
+##        python3 fsmonitor.py uninstall
+##        python3 fsmonitor.py start|stop
+##        python3 fsmonitor.py status       (watch count, journal size and how far behind git is)
+##
+## If the watcher isn't running, the hook starts it and tells git that everything may have changed, so
+## git scans the working tree as it would without the hook. The same happens when the kernel drops
+## events (queue overflow) or the journal gets too big: the watcher starts a new journal, and tokens
+## from the old one get the "everything" answer.
+from subprocess import DEVNULL
+import os, sys, time
+from os import path
+from gittrace import Popen, call
+from refsnapshot import find_git_dir
+from daemonclient import socket_path, daemon_request
+from core import git_output
+
+SOCKET_NAME = 'better-git-fsmonitor.sock'
+LOCK_NAME = 'better-git-fsmonitor.lock'
+TOKEN_PREFIX = 'better-git'
+MAX_JOURNAL = 100000
+## what core.untrackedCache was before install (UNSET if it wasn't set), for uninstall to restore
+PREVIOUS_UNTRACKED_CACHE = 'better-git.fsmonitoruntrackedcache'
+UNSET = '(unset)'
+## inotify constants (from <sys/inotify.h>)
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x2, 0x4, 0x8, 0x40, 0x80
+IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF = 0x100, 0x200, 0x400, 0x800
+IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR = 0x4000, 0x8000, 0x1000000, 0x40000000
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+	| IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+class Inotify:
+	def __init__(self):
+		import ctypes, ctypes.util
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		self.ctypes = ctypes
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+	def add_watch(self, folder):
+		## returns the watch descriptor, raises OSError (eg ENOSPC when out of watches)
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+		if wd < 0:
+			err = self.ctypes.get_errno()
+			raise OSError(err, os.strerror(err), folder)
+		return wd
+	def read_events(self):
+		## yields (watch descriptor, mask, name) for the events that are waiting, without blocking
+		import struct
+		while True:
+			try:
+				data = os.read(self.fd, 1 << 16)
+			except BlockingIOError:
+				return
+			i = 0
+			while i + 16 <= len(data):
+				wd, mask, _, name_len = struct.unpack_from('iIII', data, i)
+				name = data[i+16:i+16+name_len].rstrip(b'\0')
+				i += 16 + name_len
+				yield wd, mask, os.fsdecode(name)
+	def close(self):
+		os.close(self.fd)
+
+class Watcher:
+	def __init__(self, work_tree):
+		self.work_tree = work_tree
+		self.inotify = Inotify()
+		self.folders = {} # watch descriptor -> folder (relative to the working tree, '' for the top)
+		self.journal = {} # path -> sequence number of its last change
+		self.seq = 0
+		self.instance = None
+		self.new_journal()
+		self.events = 0
+		self.overflows = 0
+		self.watch_errors = 0
+		self.last_query = None # (sequence number, time) of the last token given to git
+		self.complete = True # False if some folders could not be watched
+	def new_journal(self):
+		## tokens from before this can't be answered any more
+		self.instance = '%x-%x' % (os.getpid(), time.time_ns())
+		self.journal.clear()
+	def watch_tree(self, folder):
+		## watches folder and every folder in it (except .git), returns the number of folders added
+		count = 0
+		for root, dirs, _ in os.walk(path.join(self.work_tree, folder)):
+			rel = path.relpath(root, self.work_tree).replace(os.sep, '/')
+			if rel == '.': rel = ''
+			dirs[:] = [d for d in dirs if not (rel == '' and d == '.git')]
+			try:
+				self.folders[self.inotify.add_watch(root)] = rel
+				count += 1
+			except FileNotFoundError:
+				pass # deleted already, its parent reports that
+			except OSError:
+				## out of inotify watches (see /proc/sys/fs/inotify/max_user_watches), changes in here would be missed
+				self.watch_errors += 1
+				self.complete = False
+		return count
+	def process_events(self):
+		for wd, mask, name in self.inotify.read_events():
+			self.events += 1
+			if mask & IN_Q_OVERFLOW:
+				self.overflows += 1
+				self.new_journal()
+				continue
+			folder = self.folders.get(wd)
+			if folder is None: continue
+			if mask & IN_IGNORED:
+				del self.folders[wd]
+				continue
+			if len(name) == 0: continue # about the folder itself, its parent reports it too
+			if folder == '' and name == '.git': continue
+			rel = name if folder == '' else folder + '/' + name
+			if mask & IN_ISDIR:
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					self.watch_tree(rel)
+				elif mask & IN_MOVED_FROM:
+					## the watches follow the folder to its new name, forget them (IN_MOVED_TO adds new ones)
+					for w in [w for w, f in self.folders.items() if f == rel or f.startswith(rel + '/')]: del self.folders[w]
+				self._changed(rel + '/')
+			else:
+				self._changed(rel)
+		if len(self.journal) > MAX_JOURNAL: self.new_journal()
+	def _changed(self, rel):
+		self.seq += 1
+		self.journal[rel] = self.seq
+	def query(self, token):
+		## returns (new token, changed paths), with None instead of the paths if everything may have changed
+		self.process_events() # so changes made right before git asked are included
+		new_token = '%s:%s:%s' % (TOKEN_PREFIX, self.instance, self.seq)
+		self.last_query = (self.seq, time.time())
+		parts = token.split(':')
+		if not self.complete or len(parts) != 3 or parts[0] != TOKEN_PREFIX or parts[1] != self.instance:
+			return new_token, None
+		since = int(parts[2])
+		return new_token, [p for p, s in self.journal.items() if s > since]
+	def health(self):
+		lag, age = None, None
+		if self.last_query is not None:
+			lag = self.seq - self.last_query[0]
+			age = time.time() - self.last_query[1]
+		return {'pid': os.getpid(), 'work_tree': self.work_tree, 'watches': len(self.folders), 'watch_limit': _max_user_watches(),
+				'watch_errors': self.watch_errors, 'events': self.events, 'overflows': self.overflows,
+				'journal': len(self.journal), 'seq': self.seq, 'lag': lag, 'last_query_age': age}
+
+def serve():
+	import fcntl, socket, select, json
+	git_dir = find_git_dir()
+	if git_dir is None or git_dir.work_tree is None:
+		print('Error: not in a git working tree')
+		sys.exit(1)
+	## only one watcher per repository (the hook may start another one while the first is still starting up)
+	lock = open(path.join(git_dir.git_dir, LOCK_NAME), 'w')
+	try:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		sys.exit(0)
+	watcher = Watcher(path.abspath(git_dir.work_tree))
+	watcher.watch_tree('')
+	sock_path = socket_path(git_dir.git_dir, SOCKET_NAME)
+	if path.exists(sock_path): os.remove(sock_path)
+	os.umask(0o077)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(sock_path)
+	server.listen(16)
+	stopping = False
+	try:
+		while not stopping and path.isdir(git_dir.git_dir):
+			readable, _, _ = select.select([watcher.inotify.fd, server], [], [], 60)
+			if watcher.inotify.fd in readable:
+				watcher.process_events()
+			if server in readable:
+				conn, _ = server.accept()
+				with conn, conn.makefile('rwb') as f:
+					try:
+						request = json.loads(f.readline())
+						if request.get('op') == 'query':
+							token, paths = watcher.query(str(request.get('token', '')))
+							reply = {'token': token, 'paths': paths}
+						elif request.get('op') == 'stop':
+							stopping = True
+							reply = {'pid': os.getpid()}
+						else:
+							reply = watcher.health()
+						f.write(json.dumps(reply).encode('utf8') + b'\n')
+					except (OSError, ValueError):
+						pass
+	finally:
+		server.close()
+		if path.exists(sock_path): os.remove(sock_path)
+		watcher.inotify.close()
+
+def hook(version, token):
+	## what git runs: prints the new token and the paths changed since token, all NUL-terminated
+	if version != '2':
+		sys.exit(1) # git then falls back to scanning
+	git_dir = find_git_dir()
+	reply = None if git_dir is None else daemon_request(git_dir.git_dir, 'query', socket_name=SOCKET_NAME, token=token)
+	if reply is None:
+		if git_dir is not None: start_watcher(wait=False)
+		reply = {'token': '%s:none:0' % TOKEN_PREFIX, 'paths': None}
+	paths = ['/'] if reply['paths'] is None else reply['paths']
+	out = sys.stdout.buffer
+	out.write(reply['token'].encode('utf8') + b'\0')
+	for p in paths: out.write(p.encode('utf8') + b'\0')
+	out.flush()
+
+def start_watcher(wait=True):
+	Popen([sys.executable, path.abspath(__file__), 'serve'], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+		  close_fds=True, start_new_session=True)
+	if not wait: return None
+	## the first crawl of a big working tree can take a while
+	git_dir = find_git_dir()
+	for _ in range(600):
+		time.sleep(0.1)
+		if (reply := daemon_request(git_dir.git_dir, 'status', socket_name=SOCKET_NAME)) is not None:
+			return reply
+	return None
+def install():
+	if not sys.platform.startswith('linux'):
+		print('Error: the better-git fsmonitor hook needs Linux (inotify)')
+		sys.exit(1)
+	git_dir = find_git_dir()
+	if git_dir is None or git_dir.work_tree is None:
+		print('Error: not in a git working tree')
+		sys.exit(1)
+	hook_command = '"%s" "%s" hook' % (sys.executable, path.abspath(__file__))
+	## remember what core.untrackedCache was, so uninstall can put it back (only if this changes it, so
+	## installing twice doesn't forget the original)
+	untracked_cache = git_output('config', '--local', '--get', 'core.untrackedCache').strip()
+	if untracked_cache != 'true':
+		call(['git', 'config', PREVIOUS_UNTRACKED_CACHE, untracked_cache if len(untracked_cache) > 0 else UNSET])
+	for key, value in (('core.fsmonitor', hook_command), ('core.fsmonitorHookVersion', '2'), ('core.untrackedCache', 'true')):
+		if call(['git', 'config', key, value]) != 0:
+			print('Error: failed to set %s' % key)
+			sys.exit(1)
+	reply = daemon_request(git_dir.git_dir, 'status', socket_name=SOCKET_NAME) or start_watcher()
+	if reply is None:
+		print('Installed the fsmonitor hook, but the watcher did not start (git will scan the working tree as usual)')
+		sys.exit(1)
+	print('Installed the fsmonitor hook, watching %s folders' % reply['watches'])
+def uninstall():
+	git_dir = find_git_dir()
+	if git_dir is None:
+		print('Error: not in a git repository')
+		sys.exit(1)
+	configured = git_output('config', '--get', 'core.fsmonitor').strip()
+	if path.abspath(__file__) in configured:
+		call(['git', 'config', '--unset', 'core.fsmonitor'])
+		call(['git', 'config', '--unset', 'core.fsmonitorHookVersion'])
+	previous = git_output('config', '--local', '--get', PREVIOUS_UNTRACKED_CACHE).strip()
+	if len(previous) > 0:
+		if previous == UNSET:
+			call(['git', 'config', '--unset', 'core.untrackedCache'])
+		else:
+			call(['git', 'config', 'core.untrackedCache', previous])
+		call(['git', 'config', '--unset', PREVIOUS_UNTRACKED_CACHE])
+	daemon_request(git_dir.git_dir, 'stop', socket_name=SOCKET_NAME)
+	print('Uninstalled the fsmonitor hook')
+def print_health():
+	git_dir = find_git_dir()
+	if git_dir is None:
+		print('Error: not in a git repository')
+		sys.exit(1)
+	configured = path.abspath(__file__) in git_output('config', '--get', 'core.fsmonitor')
+	print('Hook: %s' % ('installed' if configured else 'not installed (run: python3 fsmonitor.py install)'))
+	h = daemon_request(git_dir.git_dir, 'status', socket_name=SOCKET_NAME)
+	if h is None:
+		print('Watcher: not running')
+		return
+	print('Watcher: running (pid %s) for %s' % (h['pid'], h['work_tree']))
+	print('Watches: %s folders (limit %s per user)%s' % (h['watches'], h['watch_limit'],
+		'' if h['watch_errors'] == 0 else ', %s folders could NOT be watched, so git scans everything' % h['watch_errors']))
+	print('Events: %s seen, %s paths in the journal, %s queue overflows' % (h['events'], h['journal'], h['overflows']))
+	if h['lag'] is None:
+		print('Token lag: git has not asked yet')
+	else:
+		print('Token lag: %s changes since git last asked (%.0f seconds ago)' % (h['lag'], h['last_query_age']))
+
+def _max_user_watches():
+	try:
+		with open('/proc/sys/fs/inotify/max_user_watches', 'r') as fin:
+			return int(fin.read().strip())
+	except (OSError, ValueError):
+		return None
+def main():
+	command = sys.argv[1] if len(sys.argv) > 1 else None
+	if command == 'hook' and len(sys.argv) >= 3:
+		hook(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else '')
+	elif command == 'serve':
+		serve()
+	elif command == 'install':
+		install()
+	elif command == 'uninstall':
+		uninstall()
+	elif command == 'start':
+		git_dir = find_git_dir()
+		if git_dir is None:
+			print('Error: not in a git repository')
+			sys.exit(1)
+		reply = daemon_request(git_dir.git_dir, 'status', socket_name=SOCKET_NAME) or start_watcher()
+		print('Watcher running (pid %s)' % reply['pid'] if reply is not None else 'Error: the watcher did not start')
+	elif command == 'stop':
+		git_dir = find_git_dir()
+		reply = None if git_dir is None else daemon_request(git_dir.git_dir, 'stop', socket_name=SOCKET_NAME)
+		print('Watcher stopped' if reply is not None else 'The watcher is not running')
+	elif command == 'status':
+		print_health()
+	else:
+		print('usage: python3 fsmonitor.py install|uninstall|start|stop|status')
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
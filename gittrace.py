@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Opt-in tracing of every git process better-git starts. Turn it on with the --trace flag or by setting
+## the BETTER_GIT_TRACE environment variable (to 1, or to the file name to write the trace to).
+## Each git call is recorded with its argv, wall time, exit code and bytes of output, and the time spent
+## waiting for the user to answer a prompt is recorded separately. At exit the trace is written as
+## Chrome trace-event JSON (open it in chrome://tracing or https://ui.perfetto.dev) and a one-line
+## summary is printed.
+## When tracing is off, Popen and call are the plain subprocess versions.
+import subprocess, os, sys, time, atexit, threading
+from os import path
+
+_trace_env = os.environ.get('BETTER_GIT_TRACE', '')
+enabled = '--trace' in sys.argv[1:] or (len(_trace_env) > 0 and _trace_env.lower() not in ('0', 'no', 'false'))
+if '--trace' in sys.argv[1:]: sys.argv.remove('--trace')
+_events = []
+_t0 = time.perf_counter()
+
+class _CountingReader:
+	## wraps a process's stdout to count the bytes read from it
+	def __init__(self, stream, trace):
+		self._stream = stream
+		self._trace = trace
+	def read(self, *args):
+		data = self._stream.read(*args)
+		self._trace['out_bytes'] += len(data)
+		return data
+	def readline(self, *args):
+		data = self._stream.readline(*args)
+		self._trace['out_bytes'] += len(data)
+		return data
+	def __iter__(self):
+		for data in self._stream:
+			self._trace['out_bytes'] += len(data)
+			yield data
+	def __getattr__(self, name):
+		return getattr(self._stream, name)
+
+class TracedPopen(subprocess.Popen):
+	def __init__(self, args, *pargs, **kwargs):
+		self._trace = {'argv': [str(a) for a in args], 'start': time.perf_counter(), 'end': None,
+					   'exit_code': None, 'out_bytes': 0, 'tid': threading.get_ident()}
+		_events.append(self._trace)
+		super().__init__(args, *pargs, **kwargs)
+		if self.stdout is not None: self.stdout = _CountingReader(self.stdout, self._trace)
+	def _trace_done(self):
+		if self.returncode is not None and self._trace['end'] is None:
+			self._trace['end'] = time.perf_counter()
+			self._trace['exit_code'] = self.returncode
+	def wait(self, timeout=None):
+		r = super().wait(timeout)
+		self._trace_done()
+		return r
+	def poll(self):
+		r = super().poll()
+		self._trace_done()
+		return r
+	def communicate(self, *args, **kwargs):
+		counted = self._trace['out_bytes']
+		o, e = super().communicate(*args, **kwargs)
+		## with several pipes, communicate() reads the file descriptors directly, bypassing the counter
+		if self._trace['out_bytes'] == counted and o is not None: self._trace['out_bytes'] += len(o)
+		if e is not None: self._trace['out_bytes'] += len(e)
+		self._trace_done()
+		return o, e
+
+def traced_call(args, **kwargs):
+	with TracedPopen(args, **kwargs) as p:
+		return p.wait()
+def user_input(prompt=''):
+	## input(), timed separately from git when tracing
+	if not enabled:
+		return input(prompt)
+	trace = {'argv': None, 'start': time.perf_counter(), 'end': None, 'tid': threading.get_ident()}
+	_events.append(trace)
+	try:
+		return input(prompt)
+	finally:
+		trace['end'] = time.perf_counter()
+
+def _subcommand(argv):
+	for a in argv[1:]:
+		if not a.startswith('-'): return a
+	return argv[0]
+def _write_trace():
+	import json, tempfile
+	end = time.perf_counter()
+	pid = os.getpid()
+	trace_events = []
+	git_time = {}
+	input_time = 0.0
+	for ev in _events:
+		dur = (ev['end'] if ev['end'] is not None else end) - ev['start']
+		if ev['argv'] is None:
+			input_time += dur
+			trace_events.append({'name': 'user input', 'cat': 'input', 'ph': 'X', 'pid': pid, 'tid': ev['tid'],
+								 'ts': (ev['start'] - _t0) * 1e6, 'dur': dur * 1e6})
+		else:
+			name = _subcommand(ev['argv'])
+			git_time[name] = git_time.get(name, 0.0) + dur
+			trace_events.append({'name': 'git %s' % name, 'cat': 'git', 'ph': 'X', 'pid': pid, 'tid': ev['tid'],
+								 'ts': (ev['start'] - _t0) * 1e6, 'dur': dur * 1e6,
+								 'args': {'argv': ev['argv'], 'exit_code': ev['exit_code'], 'out_bytes': ev['out_bytes']}})
+	trace_file = _trace_env if len(_trace_env) > 0 and _trace_env.lower() not in ('1', 'yes', 'true') \
+		else path.join(tempfile.gettempdir(), 'better-git-trace-%s.json' % pid)
+	try:
+		with open(trace_file, 'w') as fout:
+			json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, fout)
+	except OSError as e:
+		print('Failed to write trace file %s: %s' % (trace_file, e), file=sys.stderr)
+		trace_file = None
+	git_calls = len([ev for ev in _events if ev['argv'] is not None])
+	by_command = ', '.join('%s %.2fs' % (k, v) for k, v in sorted(git_time.items(), key=lambda kv: -kv[1]))
+	print('better-git trace: %s git calls, git %.2fs (%s), user input %.2fs, total %.2fs%s' % (
+		git_calls, sum(git_time.values()), by_command, input_time, end - _t0,
+		'' if trace_file is None else ' -> %s' % trace_file), file=sys.stderr)
+if enabled:
+	Popen = TracedPopen
+	call = traced_call
+	atexit.register(_write_trace)
+else:
+	Popen = subprocess.Popen
+	call = subprocess.call
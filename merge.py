@@ -3,41 +3,61 @@
 # Copyright 2021 Christopher C. Hall
 # Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
 # https://creativecommons.org/licenses/by/4.0/
-from subprocess import call, Popen, PIPE, STDOUT
-import os, sys, re
+from subprocess import PIPE, STDOUT, DEVNULL
+import os, sys, re, time
 from os import path
+from core import run, test_run, confirm, choose_from, ask_for_text
+from gittrace import Popen
+from refsnapshot import ref_snapshot
+from fetcher import fetch
+from catfile import cat_file
+from conflictpreview import preview_conflicts
+from mergecleanup import list_unresolved, record_merge_artifacts, clean_merge_artifacts, merge_start_time
+from branchnotes import branch_notes
 
 def main():
 	# check if in a merge
 	if not merge_in_progress():
 		# abort if there are uncommited changes
+		## always asked of git: a cached answer could miss an edit made a moment ago
 		changes = run('git', 'status', '-uall', '--porcelain', capture_stdout=True,
 					  fail_msg='Cannot merge, current working directory is not in a git repository!')
 		## store current commit hash for undo capability
-		this_branch = run('git', 'symbolic-ref', '--short', '-q', 'HEAD',
-						  capture_stdout=True).strip()
+		this_branch = ref_snapshot().current_branch()
 		## with --porcelain, changes will be an empty string if there are no uncommitted changes
 		if len(changes.strip()) > 0:
 			## uncommitted changes detected, abort
 			print('Error: uncommitted changes detected! Commit first and then merge.')
-			exit(1)
+			sys.exit(1)
 		# ask which branch/commit to merge from and to
-		run('git', 'fetch', '--all')
-		branch_list = [x for x in run('git', 'for-each-ref', '--format', '%(refname:short)', 'refs/heads/',
-									  capture_stdout=True).replace('\r', '').split('\n') if len(x) > 0]
+		fetch()
+		branch_list = ref_snapshot().branches()
+		if '--forecast' in sys.argv[1:]:
+			merge_forecast()
 		print('Currently on branch:',this_branch)
-		_, m_from = choose_from('Which branch do you want to merge from?', branch_list)
+		## ahead/behind the current branch, last commit date and subject of each branch
+		notes = branch_notes(branch_list)
+		_, m_from = choose_from('Which branch do you want to merge from?', branch_list, notes=notes)
 		if len(m_from) == 0: m_from = this_branch
-		_, m_to = choose_from('Which branch do you want to merge into?', branch_list)
+		_, m_to = choose_from('Which branch do you want to merge into?', branch_list, notes=notes)
 		if len(m_to) == 0: m_to = this_branch
 		if m_from == m_to:
 			print('Error: From-branch and into-merge branch must be different')
-			exit(1)
+			sys.exit(1)
 		## test that both branches exist
-		run('git', 'cat-file', '-e', m_from, fail_msg='Error: target "%s" does not exist' % m_from)
-		run('git', 'cat-file', '-e', m_to, fail_msg='Error: target "%s" does not exist' % m_to)
+		for target, info in zip((m_from, m_to), cat_file().query_many([m_from, m_to])):
+			if info is None:
+				print('Error: target "%s" does not exist' % target)
+				sys.exit(1)
 		# test for merge conflicts
-		if no_merge_conflicts(m_from, m_to, this_branch):
+		## (merging in memory also gives a preview of the conflicts, without touching the working tree)
+		preview = preview_conflicts(m_from, m_to)
+		if preview is None:
+			## git is too old to merge in memory, test the merge in the working tree instead
+			clean_merge = no_merge_conflicts(m_from, m_to, this_branch)
+		else:
+			clean_merge = len(preview.files) == 0
+		if clean_merge:
 			print('No merge conflicts detected.')
 			# can do simple merge, ask user for confirmation
 			if confirm('Merge %s -> %s?' % (m_from, m_to)):
@@ -46,52 +66,58 @@ def main():
 				run('git', 'switch', m_to)
 				run('git', 'merge', m_from)
 				print('Done!')
-				exit(0)
+				sys.exit(0)
 		else:
 			# merge conflicts exist
 			print('Merge conflicts detected. You will need to resolve them before you can merge.')
+			if preview is not None: conflict_preview_ui(preview)
 			if not confirm('Start merge operation?'):
 				print('Merge canceled.')
-				exit(0)
+				sys.exit(0)
 			# start merge and show conflicts
 			run('git', 'switch', m_to)
+			merge_start = time.time()
 			test_run('git', 'merge', '--no-commit', '--no-ff', m_from) # git merge will return an error code here, even on success
 			unresolved_files = list_unresolved()
+			## remember what the merge leaves behind, so only that is deleted when the merge is done or aborted
+			record_merge_artifacts(unresolved_files, merge_start)
 			print('Files with unresolved merge conflicts:')
 			for f in unresolved_files: print('\t', f, sep='')
 			# ask user if they would like to use the git merge tool
 			if not merge_tool_ui(this_branch):
 				print('Edit the files to resolve all conflicts, then re-run this command.')
 				# exit
-				exit(0)
+				sys.exit(0)
 	else:
 		print('Merge operation in progress.')
 		# show unresolved files (git diff --name-only --diff-filter=U)
 		unresolved_files = list_unresolved()
+		## also catch leftovers from merge tools that were run outside of better-git
+		record_merge_artifacts(unresolved_files, merge_start_time())
 		if len(unresolved_files) > 0:
 			print('The following files are marked as unresolved:')
 			for f in unresolved_files: print('\t', f, sep='')
 		# ask if user wants to abort the merge
 		if confirm('Abort merge?'):
 			run('git', 'merge', '--abort')
-			run('git', 'clean', '-f')
+			clean_merge_artifacts()
 			print('Merge aborted.')
-			exit(0)
+			sys.exit(0)
 		# if there are unresolved files, ask if user wants to run the merge tool
 		if len(unresolved_files) > 0: merge_tool_ui()
 		# Ask user if all conflicts have been resolved
 		if confirm('Have ALL merge conflicts been resolved and all changes tested?') and confirm('Confirm merge?'):
-			# If yes, complete merge and clean up (git clean -f)
+			# If yes, clean up (before git add, so the merge leftovers are not committed) and complete merge
 			merge_msg = ask_for_text('Merge commit message')
+			clean_merge_artifacts()
 			run('git', 'add', '--all')
 			run('git', 'commit', '-m', merge_msg)
-			run('git', 'clean', '-f')
 			print('Done!')
-			exit(0)
+			sys.exit(0)
 		else:
 			# If no, exit script
 			print('Resolve any merge conflicts and re-run this command when you are ready to complete the merge or wish to abort.')
-			exit(0)
+			sys.exit(0)
 	# Done
 	print('Done!')
 
@@ -99,12 +125,16 @@ def merge_tool_ui(revert_commit=None):
 	merge_tool = run('git', 'config', '--get', 'merge.tool', capture_stdout=True).replace('\r', '').replace('\n', '')
 	if confirm('Resolve conflicts using %s?' % merge_tool):
 		# run mergetool command
+		tool_paths = list_unresolved()
+		tool_start = time.time()
 		mt_sucess = test_run('git', 'mergetool', hide_output=False)
+		## the merge tool can leave .orig backups and temporary copies next to the files
+		record_merge_artifacts(tool_paths, tool_start)
 		## Note: git mergetool will ask 'Was the merge successful [y/n]?' at the end if the merge tool program exits non-zero,
 		## and return non-zero if user says 'no' (and mark all files ar resolved if 'yes' and exits with code 0)
 		if mt_sucess == False:
 			print('Edit the files to resolve all conflicts, then re-run this command.')
-			exit(0)
+			sys.exit(0)
 		# ask if merge is done
 		if confirm('Ready to complete merge operation?'):
 			unresolved_files = list_unresolved()
@@ -112,99 +142,114 @@ def merge_tool_ui(revert_commit=None):
 				print('The following files are still marked as unresolved:')
 				for f in unresolved_files: print('\t', f, sep='')
 				if confirm('Mark all files as resolved?'):
+					## the leftovers must be gone before anything is staged, or they would be committed
+					clean_merge_artifacts()
 					run('git', 'add', '--all')
 			if confirm('Have all changes been tested? Confirm merge:'):
 				if revert_commit is not None:
 					merge_msg = 'merged commit %s into this branch' % revert_commit
 				else:
 					merge_msg = ask_for_text('Merge commit message')
+				clean_merge_artifacts()
 				run('git', 'add', '--all')
 				run('git', 'commit', '-m', merge_msg)
-				run('git', 'clean', '-f')
 				print('Done!')
-				exit(0)
+				sys.exit(0)
 		# if not done, ask if user wants to abort the merge (git merge --abort)
 		if confirm('Abort merge?'):
 			run('git', 'merge', '--abort')
-			run('git', 'clean', '-f')
+			clean_merge_artifacts()
 			if revert_commit is not None: run('git', 'switch', revert_commit)
 			print('Merge aborted.')
-			exit(0)
+			sys.exit(0)
 	return False
 
+def conflict_preview_ui(preview):
+	## lets the user look through the conflicts before deciding whether to start the merge
+	if preview.print_summary() and confirm('List all %s files?' % len(preview.files)):
+		preview.print_all()
+	files = [f.path for f in preview.files]
+	while confirm('Show the conflicts in a file?'):
+		index, _ = choose_from('Which file?', files)
+		preview.print_hunks(preview.files[index])
 def merge_in_progress():
 	## return True if a merge is in progress, False if not
-	root_dir = run('git', 'rev-parse', '--show-toplevel', capture_stdout=True)
-	if root_dir.endswith('\n'): root_dir = root_dir[:-1]
-	if root_dir.endswith('\r'): root_dir = root_dir[:-1]
-	merge_head_file = path.join(root_dir, '.git', 'MERGE_HEAD')
+	refs = ref_snapshot()
+	if refs is None: return False # not in a git repository
+	merge_head_file = path.join(refs.dir.git_dir, 'MERGE_HEAD')
 	if path.exists(merge_head_file):
 		with open(merge_head_file, 'r') as fin:
 			return len(fin.read().strip()) > 0
 	return False
+def predict_merge_conflicts(merge_from, merge_to):
+	## merges the two branches in memory with `git merge-tree --write-tree` (git 2.38+), which never touches
+	## the index or the working tree. Returns the list of conflicting paths (empty if the merge is clean),
+	## or None if this version of git can't do that.
+	p = Popen(['git', 'merge-tree', '--write-tree', '--name-only', '--no-messages', '-z', merge_to, merge_from],
+			  stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	if p.returncode not in (0, 1):
+		return None
+	## output is the merged tree hash followed by the conflicting paths, all NUL-terminated
+	fields = [x for x in o.decode('utf8').split('\0') if len(x) > 0]
+	conflicts = list(dict.fromkeys(fields[1:])) # a path can be listed once per conflicting stage
+	if p.returncode == 1 and len(conflicts) == 0:
+		return None
+	return conflicts
+def merge_forecast():
+	## shows which pairs of local branches would conflict if merged, testing all the pairs in parallel
+	import json
+	from concurrent.futures import ThreadPoolExecutor
+	tips = {name[len('refs/heads/'):]: tip for name, tip in ref_snapshot().list('refs/heads/')}
+	names = sorted(tips)
+	pairs = [(a, b) for i, a in enumerate(names) for b in names[i+1:]]
+	## results are cached by the tip hashes of both branches, so pairs that haven't changed are not re-tested
+	cache_file = run('git', 'rev-parse', '--git-path', 'better-git-merge-forecast.json', capture_stdout=True).strip()
+	cache = {}
+	if path.exists(cache_file):
+		try:
+			with open(cache_file, 'r') as fin:
+				cache = json.load(fin)
+		except (OSError, ValueError):
+			cache = {}
+	def cache_key(a, b):
+		return ' '.join(sorted((tips[a], tips[b])))
+	todo = list(dict.fromkeys(cache_key(a, b) for a, b in pairs if cache_key(a, b) not in cache))
+	if len(todo) > 0:
+		print('Testing %s of %s branch pairs for merge conflicts...' % (len(todo), len(pairs)))
+		with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+			for key, conflicts in zip(todo, pool.map(lambda k: predict_merge_conflicts(*k.split(' ')), todo)):
+				## -1 means git couldn't merge the pair in memory (eg old git or unrelated histories)
+				cache[key] = -1 if conflicts is None else len(conflicts)
+	## only keep the results for the current branch tips
+	cache = {cache_key(a, b): cache[cache_key(a, b)] for a, b in pairs}
+	try:
+		with open(cache_file, 'w') as fout:
+			json.dump(cache, fout)
+	except OSError:
+		pass
+	clean_count = 0
+	print('Merge forecast:')
+	for a, b in pairs:
+		n = cache[cache_key(a, b)]
+		if n == 0:
+			clean_count += 1
+		elif n < 0:
+			print('\t%s <-> %s: unknown' % (a, b))
+		else:
+			print('\t%s <-> %s: %s conflicting file%s' % (a, b, n, '' if n == 1 else 's'))
+	print('%s of %s branch pairs merge cleanly.' % (clean_count, len(pairs)))
+	print()
 def no_merge_conflicts(merge_from, merge_to, revert_to):
 	# git checkout fails if already on that branch, switch does not
 	run('git', 'switch', merge_to, capture_stdout=True)
+	merge_start = time.time()
 	can_merge = test_run('git', 'merge', '--no-commit', '--no-ff', merge_from, hide_output=False)
+	record_merge_artifacts(list_unresolved(), merge_start)
 	test_run('git', 'merge', '--abort') ## undo test merge
+	clean_merge_artifacts()
 	run('git', 'switch', revert_to, capture_stdout=True)
 	return can_merge
-def list_unresolved():
-	return [x for x in run('git', 'diff', '--name-only', '--diff-filter=U',
-									  capture_stdout=True).replace('\r', '').split('\n') if len(x) > 0]
-#
-def ask_for_text(msg, **kwargs):
-	print("%s: " % msg, **kwargs)
-	return input()
-def confirm(msg):
-	while True:
-		r = input('%s [y/n]: ' % msg).strip().lower()
-		if r == 'y' or r == 'yes':
-			return True
-		elif r == 'n' or r == 'no':
-			return False
-		else:
-			continue
-def choose_from(msg, options_list):
-	while True:
-		try:
-			print(msg)
-			num = 1
-			for opt in options_list:
-				print('%s:\t%s' % (num, opt))
-				num += 1
-			r = input('Enter number: ')
-			i = int(r)-1
-			return i, options_list[i]
-		except ValueError:
-			print('Not a number, try again.')
-		except IndexError:
-			print('Not a valid option, try again.')
-def run(command, *args, fail_msg=None, capture_stdout=False):
-	args = list(args) # convert tuple to list
-	if fail_msg == None:
-		fail_msg = "Error: non-zero exit code returned by %s %s" % (command," ".join(args))
-	if capture_stdout == False:
-		exit_code = call([command]+args)
-		ret_val = None
-	else:
-		p = Popen([command]+args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		o, e = p.communicate()
-		if e is not None and len(e) > 0: print(e.decode('utf8'), file=sys.stderr)
-		ret_val = o.decode('utf8')
-		exit_code = p.returncode
-	if exit_code != 0:
-		print(fail_msg)
-		exit(1)
-	return ret_val
-def test_run(command, *args, hide_output=True):
-	args = list(args)
-	if hide_output:
-		p = Popen([command] + args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		exit_code = p.wait()
-	else:
-		exit_code = call([command] + args)
-	return exit_code == 0
 #
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Cleans up after a merge by deleting only the files the merge left behind, instead of `git clean -f`,
+## which deletes every untracked file in the working tree (including build outputs). After each merge or
+## mergetool step, the files it created next to the conflicted files are added to a manifest in the git
+## dir (.git/better-git-merge-manifest.json):
+##   file.orig                        backups made by git mergetool
+##   file_BASE_1234.ext (and _LOCAL_, _REMOTE_, _BACKUP_)   mergetool's temporary copies
+##   file~HEAD, file~branch           the other version of a file, written by git merge for some conflicts
+## Only the folders of the conflicted files are looked at, so the cost depends on how many files the
+## merge touched, not on the size of the working tree.
+from subprocess import PIPE, DEVNULL
+import os, re, json
+from os import path
+from gittrace import Popen
+from core import run
+from refsnapshot import ref_snapshot
+
+MANIFEST_FILE = 'better-git-merge-manifest.json'
+TEMP_FILE_PATTERN = re.compile('^(.*)_(BASE|LOCAL|REMOTE|BACKUP)_\\d+(\\.[^.]*)?$')
+## file systems with coarse timestamps can give a new file a modification time slightly in the past
+MTIME_SLACK = 2
+
+def list_unresolved():
+	## paths (from the top of the working tree) of the files with unresolved merge conflicts
+	return [x for x in run('git', 'diff', '--name-only', '--diff-filter=U',
+									  capture_stdout=True).replace('\r', '').split('\n') if len(x) > 0]
+def record_merge_artifacts(conflicted_paths, since):
+	## adds the merge leftovers of conflicted_paths that were created or changed since the given time (from time.time())
+	work_tree = ref_snapshot().dir.work_tree
+	found = [f for f in _artifacts(work_tree, conflicted_paths) if _mtime(path.join(work_tree, f)) >= since - MTIME_SLACK]
+	if len(found) == 0: return
+	manifest = _load_manifest()
+	manifest.update(dict.fromkeys(found))
+	_save_manifest(manifest)
+def merge_start_time():
+	## when the merge in progress was started (the time git wrote MERGE_HEAD)
+	return _mtime(path.join(ref_snapshot().dir.git_dir, 'MERGE_HEAD'))
+def clean_merge_artifacts():
+	## deletes the files in the manifest that still exist and are not committed, then the manifest itself.
+	## Returns the paths that were deleted.
+	manifest = list(_load_manifest())
+	deleted = []
+	if len(manifest) > 0:
+		work_tree = ref_snapshot().dir.work_tree
+		## a leftover that someone has since committed is no longer ours to delete. This is decided by HEAD,
+		## not the index: a `git add --all` during the merge stages the leftovers too.
+		p = Popen(['git', '-C', work_tree, 'ls-tree', '-r', '-z', '--name-only', '--full-tree', 'HEAD', '--'] + manifest,
+				  stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+		o, _ = p.communicate()
+		committed = set(o.decode('utf8').split('\0'))
+		for f in manifest:
+			if f in committed: continue
+			try:
+				os.remove(path.join(work_tree, f))
+				deleted.append(f)
+			except FileNotFoundError:
+				pass
+		## and if they were staged, unstage them
+		if len(deleted) > 0:
+			Popen(['git', '-C', work_tree, 'rm', '--cached', '-q', '--ignore-unmatch', '--'] + deleted,
+				  stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, close_fds=True).wait()
+	manifest_file = _manifest_file()
+	if path.exists(manifest_file): os.remove(manifest_file)
+	return deleted
+
+def _artifacts(work_tree, conflicted_paths):
+	## yields the files next to each conflicted path that look like merge leftovers of it
+	by_dir = {}
+	for p in conflicted_paths:
+		d, name = path.split(p)
+		by_dir.setdefault(d, set()).add(name)
+	for d, names in by_dir.items():
+		try:
+			entries = os.listdir(path.join(work_tree, d) if len(d) > 0 else work_tree)
+		except OSError:
+			continue
+		stems = {path.splitext(n)[0]: n for n in names}
+		for e in entries:
+			if e in names: continue
+			owner = None
+			if e.endswith('.orig'):
+				owner = e[:-len('.orig')]
+			elif '~' in e:
+				owner = e[:e.rfind('~')]
+			elif (m := TEMP_FILE_PATTERN.match(e)) is not None:
+				owner = stems.get(m.group(1))
+			if owner in names:
+				yield e if len(d) == 0 else d + '/' + e
+def _mtime(filename):
+	## on Linux and macOS the change time also covers files renamed into place (mergetool moves the file
+	## to its _BACKUP_ name, which keeps the old modification time)
+	try:
+		st = os.stat(filename)
+		return max(st.st_mtime, st.st_ctime)
+	except OSError:
+		return 0
+def _manifest_file():
+	return path.join(ref_snapshot().dir.git_dir, MANIFEST_FILE)
+def _load_manifest():
+	## dict of path -> None (used as an ordered set)
+	try:
+		with open(_manifest_file(), 'r') as fin:
+			return dict.fromkeys(json.load(fin))
+	except (OSError, ValueError):
+		return {}
+def _save_manifest(manifest):
+	with open(_manifest_file(), 'w') as fout:
+		json.dump(list(manifest), fout, indent=1)
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Local cache of bare mirror repositories, one per remote URL, used by fork.py so that cloning the same
+## remote again only downloads what changed since the last clone. The new clone borrows objects from
+## the mirror with `git clone --reference` (or copies them with --dissociate), so a repeat clone costs
+## about as much as checking out the files.
+##
+## Turn it on with `git config --global better-git.mirrorcache true`. Other settings:
+##   better-git.mirrorcachedir     where to keep the mirrors (default ~/.cache/better-git/mirrors)
+##   better-git.mirrorcachesize    size limit of the cache, eg 50g (default 20g); least recently used
+##                                 mirrors are deleted when the cache is bigger than this
+##   better-git.mirrordissociate   true to copy the objects into each clone instead of borrowing them
+## Mirrors that a clone still borrows objects from are never deleted, because that would break the clone.
+from subprocess import DEVNULL
+import os, sys, time
+from os import path
+from gittrace import call
+from core import git_output
+
+DEFAULT_CACHE_SIZE = 20 * 1024**3
+INDEX_FILE = 'mirrors.json'
+
+def mirror_cache_enabled():
+	return _config('better-git.mirrorcache', 'bool') == 'true'
+def dissociate_clones():
+	return _config('better-git.mirrordissociate', 'bool') == 'true'
+def cache_dir():
+	configured = _config('better-git.mirrorcachedir', 'path')
+	if len(configured) > 0: return configured
+	xdg = os.environ.get('XDG_CACHE_HOME', path.join(path.expanduser('~'), '.cache'))
+	return path.join(xdg, 'better-git', 'mirrors')
+def cache_size_limit():
+	try:
+		return int(_config('better-git.mirrorcachesize', 'int'))
+	except ValueError:
+		return DEFAULT_CACHE_SIZE
+
+def mirror_key(url):
+	## the same remote can be written with or without a trailing slash or .git
+	import hashlib
+	normalized = url.strip().rstrip('/')
+	if normalized.endswith('.git'): normalized = normalized[:-4]
+	return hashlib.sha1(normalized.encode('utf8')).hexdigest()
+def prepare_mirror(url):
+	## creates or refreshes the mirror of url, returns its path (or None if that failed)
+	cache = cache_dir()
+	os.makedirs(cache, exist_ok=True)
+	key = mirror_key(url)
+	mirror = path.join(cache, key + '.git')
+	## only one process at a time may update a mirror, but different mirrors can be updated in parallel
+	with _FileLock(mirror + '.lock'):
+		if path.isdir(mirror):
+			print('Updating local mirror of %s' % url)
+			ok = call(['git', '-C', mirror, 'fetch', '--prune', '--quiet'], stdin=DEVNULL) == 0
+		else:
+			print('Creating local mirror of %s' % url)
+			ok = call(['git', 'clone', '--mirror', '--quiet', url, mirror], stdin=DEVNULL) == 0
+		size = _dir_size(mirror)
+	if not ok:
+		print('Warning: failed to update the local mirror, cloning without it', file=sys.stderr)
+		return None
+	with _IndexLock(cache) as index:
+		entry = index.setdefault(key, {'url': url, 'clones': []})
+		entry['last_used'] = time.time()
+		entry['size'] = size
+	return mirror
+def record_clone(url, clone_dir, dissociated):
+	## remembers which clones borrow objects from a mirror, so that mirror is not evicted
+	if dissociated: return
+	with _IndexLock(cache_dir()) as index:
+		entry = index.get(mirror_key(url))
+		if entry is not None and clone_dir not in entry['clones']:
+			entry['clones'].append(clone_dir)
+def evict_mirrors(max_size=None):
+	## deletes least recently used mirrors until the cache fits in max_size bytes, returns the deleted URLs
+	import shutil
+	if max_size is None: max_size = cache_size_limit()
+	cache = cache_dir()
+	evicted = []
+	with _IndexLock(cache) as index:
+		total = sum(e.get('size', 0) for e in index.values())
+		for key in sorted(index, key=lambda k: index[k].get('last_used', 0)):
+			if total <= max_size: break
+			mirror = path.join(cache, key + '.git')
+			index[key]['clones'] = [c for c in index[key]['clones'] if _borrows_from(c, mirror)]
+			if len(index[key]['clones']) > 0: continue
+			with _FileLock(mirror + '.lock'):
+				shutil.rmtree(mirror, ignore_errors=True)
+			total -= index[key].get('size', 0)
+			evicted.append(index.pop(key)['url'])
+	return evicted
+
+def _borrows_from(clone_dir, mirror):
+	alternates = path.join(clone_dir, '.git', 'objects', 'info', 'alternates')
+	try:
+		with open(alternates, 'r') as fin:
+			return any(path.normpath(ln.strip()).startswith(path.normpath(mirror)) for ln in fin)
+	except OSError:
+		return False
+def _dir_size(folder):
+	total = 0
+	for root, _, files in os.walk(folder):
+		for f in files:
+			try:
+				total += path.getsize(path.join(root, f))
+			except OSError:
+				pass
+	return total
+def _config(name, value_type):
+	return git_output('config', '--global', '--type=%s' % value_type, '--get', name).strip()
+
+class _FileLock:
+	def __init__(self, lock_file):
+		self.lock_file = lock_file
+	def __enter__(self):
+		self.lock = open(self.lock_file, 'w')
+		try:
+			import fcntl
+			fcntl.flock(self.lock, fcntl.LOCK_EX)
+		except ImportError:
+			pass # no file locking on this platform
+		return self
+	def __exit__(self, *exc):
+		self.lock.close() # also releases the lock
+		return False
+class _IndexLock(_FileLock):
+	## the cache index (url, last use, size and borrowing clones of each mirror), locked while in use so
+	## several better-git commands (eg multirepo.py) can share the cache
+	def __init__(self, cache):
+		self.file = path.join(cache, INDEX_FILE)
+		super().__init__(self.file + '.lock')
+	def __enter__(self):
+		import json
+		os.makedirs(path.dirname(self.file), exist_ok=True)
+		super().__enter__()
+		self.index = {}
+		if path.exists(self.file):
+			try:
+				with open(self.file, 'r') as fin:
+					self.index = json.load(fin)
+			except (OSError, ValueError):
+				self.index = {}
+		return self.index
+	def __exit__(self, *exc):
+		import json
+		tmp = self.file + '.tmp'
+		with open(tmp, 'w') as fout:
+			json.dump(self.index, fout, indent=1)
+		os.replace(tmp, self.file)
+		return super().__exit__(*exc)
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Runs better-git commands in many repositories at once, with the answers to every question given up
+## front in a plan file. The repositories are worked on concurrently (the steps within one repository
+## run in order), so the total time is about that of the slowest repository.
+##
+## usage: python3 multirepo.py plan.json
+##
+## plan.json:
+## {
+##   "concurrency": 16,              (optional, number of repositories worked on at once, default 8)
+##   "policy": "continue",           (optional, "continue" or "fail-fast")
+##   "log_dir": "multirepo-logs",    (optional, where to save the output from each repository)
+##   "steps": [                      (commands to run in every repository, with the answers to type in)
+##     {"command": "fork", "answers": ["origin/release/x", "release-x"]},
+##     {"command": "push", "answers": ["origin/main", "y", "n", "n", "n"]}
+##   ],
+##   "repos": ["../service-a", {"path": "../service-b", "steps": [...]}]
+## }
+## Menu answers can be the text of the option (eg "origin/release/x") instead of its number, since the
+## menus are numbered differently in each repository.
+## With "fail-fast", no new repositories are started after the first failure (the ones already running
+## are allowed to finish, so no repository is left half-way through a merge or push).
+from subprocess import PIPE, STDOUT, DEVNULL
+from concurrent.futures import ThreadPoolExecutor
+import os, sys, json, time, threading
+from os import path
+from gittrace import Popen
+
+SCRIPT_DIR = path.dirname(path.abspath(__file__))
+COMMANDS = ('fork', 'commit', 'branch', 'merge', 'push')
+
+def main():
+	if len(sys.argv) != 2:
+		print('usage: python3 multirepo.py plan.json')
+		sys.exit(1)
+	with open(sys.argv[1], 'r') as fin:
+		plan = json.load(fin)
+	plan_dir = path.dirname(path.abspath(sys.argv[1]))
+	jobs = []
+	for repo in plan.get('repos', []):
+		if isinstance(repo, str): repo = {'path': repo}
+		repo_path = path.normpath(path.join(plan_dir, repo['path']))
+		steps = repo.get('steps', plan.get('steps', []))
+		for step in steps:
+			if step.get('command') not in COMMANDS:
+				print('Error: unknown command "%s" for %s (must be one of %s)' % (step.get('command'), repo_path, ', '.join(COMMANDS)))
+				sys.exit(1)
+		jobs.append((repo_path, steps))
+	if len(jobs) == 0:
+		print('Nothing to do: the plan has no repos')
+		sys.exit(1)
+	fail_fast = plan.get('policy', 'continue') == 'fail-fast'
+	log_dir = plan.get('log_dir')
+	if log_dir is not None:
+		log_dir = path.join(plan_dir, log_dir)
+		os.makedirs(log_dir, exist_ok=True)
+	results = run_plan(jobs, int(plan.get('concurrency', 8)), fail_fast, log_dir)
+	print_results(results)
+	sys.exit(0 if all(r['status'] == 'ok' for r in results) else 1)
+
+def run_plan(jobs, concurrency, fail_fast, log_dir=None):
+	## returns a result dict for each (repository, steps) job, in the same order as jobs
+	failed = threading.Event()
+	done_count = [0]
+	lock = threading.Lock()
+	def run_job(job):
+		repo_path, steps = job
+		if fail_fast and failed.is_set():
+			return {'repo': repo_path, 'status': 'skipped', 'step': None, 'seconds': 0.0}
+		result = run_repo(repo_path, steps, log_dir)
+		if result['status'] != 'ok': failed.set()
+		with lock:
+			done_count[0] += 1
+			print('[%s/%s] %s: %s' % (done_count[0], len(jobs), repo_path, result['status']), flush=True)
+		return result
+	with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+		return list(pool.map(run_job, jobs))
+
+def run_repo(repo_path, steps, log_dir=None):
+	start = time.perf_counter()
+	log = []
+	result = {'repo': repo_path, 'status': 'ok', 'step': None, 'seconds': 0.0}
+	if not path.isdir(repo_path):
+		result['status'] = 'failed'
+		log.append('Error: %s is not a directory' % repo_path)
+	for i, step in enumerate(steps if result['status'] == 'ok' else []):
+		answers = [str(a) for a in step.get('answers', [])]
+		p = Popen([sys.executable, path.join(SCRIPT_DIR, step['command'] + '.py')], cwd=repo_path,
+				  stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
+		## if the answers run out, the command gets end-of-file at its next question and fails
+		o, _ = p.communicate(('\n'.join(answers) + '\n').encode('utf8'))
+		log.append('=== %s ===' % step['command'])
+		log.append(o.decode('utf8', errors='replace'))
+		if p.returncode != 0:
+			result['status'] = 'failed'
+			result['step'] = '%s (step %s)' % (step['command'], i + 1)
+			break
+	result['seconds'] = time.perf_counter() - start
+	if log_dir is not None:
+		## name the log after the whole path, repositories are often all called the same thing (eg "work")
+		log_name = path.normpath(repo_path).strip(os.sep).replace(os.sep, '_')
+		with open(path.join(log_dir, log_name + '.log'), 'w') as fout:
+			fout.write('\n'.join(log))
+	return result
+
+def print_results(results):
+	print()
+	for r in results:
+		print('%-8s %7.1fs  %s%s' % (r['status'], r['seconds'], r['repo'], '' if r['step'] is None else '  (failed at %s)' % r['step']))
+	counts = {}
+	for r in results: counts[r['status']] = counts.get(r['status'], 0) + 1
+	print('%s repositories: %s' % (len(results), ', '.join('%s %s' % (n, s) for s, n in sorted(counts.items()))))
+
+if __name__ == '__main__':
+	main()
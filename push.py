@@ -3,43 +3,57 @@
 # Copyright 2021 Christopher C. Hall
 # Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
 # https://creativecommons.org/licenses/by/4.0/
-from subprocess import call, Popen, PIPE, STDOUT
-import os, sys, re
+from subprocess import PIPE, STDOUT, DEVNULL
+import os, sys, re, time
 from os import path
+from core import run, test_run, confirm, choose_from, ask_for_text
+from refsnapshot import ref_snapshot
+from refindex import local_name
+from fetcher import fetch
+from gittrace import Popen
+from catfile import cat_file
+from daemonclient import daemon_remotes
+from mergecleanup import list_unresolved, record_merge_artifacts, clean_merge_artifacts
+from checks import run_checks, unpushed_changes
+from branchnotes import branch_notes
 
 def main():
 	# Check for uncommited changes, aborting if there are any
+	## always asked of git: a cached answer could miss an edit made a moment ago
 	changes = run('git', 'status', '-uall', '--porcelain', capture_stdout=True,
 				  fail_msg='Cannot push, current working directory is not in a git repository!')
-	remote_name = run('git', 'remote', capture_stdout=True, fail_msg='Failed to determine remote name of repository. Please set remote origin name and try again').strip()
+	remote_name = daemon_remotes()
+	if remote_name is None:
+		remote_name = run('git', 'remote', capture_stdout=True, fail_msg='Failed to determine remote name of repository. Please set remote origin name and try again')
+	remote_name = remote_name.strip()
 	## with --porcelain, changes will be an empty string if there are no uncommitted changes
 	if len(changes.strip()) > 0:
 		## uncommitted changes detected, abort
 		print('Error: uncommitted changes detected! Commit first and then push.')
-		exit(1)
+		sys.exit(1)
 	# Fetch list remote branches
-	run('git', 'fetch', '--all')
-	remote_branches = [x for x in run('git', 'for-each-ref', '--format', '%(refname:short)', 'refs/remotes/',
-		capture_stdout=True).replace('\r','').split('\n') if len(x) > 0]
+	fetched = fetch()
+	refs = ref_snapshot()
+	remote_branches = refs.remote_branches()
 	## get local branch info too
-	this_branch = run('git', 'symbolic-ref', '--short', '-q', 'HEAD',
-					  capture_stdout=True).strip()
-	local_branches = [x for x in run('git', 'for-each-ref', '--format', '%(refname:short)', 'refs/heads/',
-								  capture_stdout=True).replace('\r', '').split('\n') if len(x) > 0]
+	this_branch = refs.current_branch()
+	local_branches = refs.branches()
 	# Ask user which branch to push to
 	print('Currrently on branch: %s' % this_branch)
-	_, push_branch = choose_from('Choose branch to push to:', ['(new branch)']+remote_branches)
+	_, push_branch = choose_from('Choose branch to push to:', ['(new branch)']+remote_branches, keep_listed=1,
+								 notes=branch_notes(remote_branches, remote=True))
 	# special case: make new upstream branch instead of pushing to existing branch
 	if push_branch == '(new branch)':
 		push_branch = ask_for_text('New branch name')
 		if confirm('Push from local branch %s to new remote branch %s?' % (this_branch, push_branch)):
+			check_before_push(this_branch)
 			run('git', 'push', '--set-upstream', remote_name, '%s:%s' % (this_branch,push_branch))
 			print('Done!')
-			exit(0)
+			sys.exit(0)
 	# get user confirmation
 	if not confirm('Push from local branch %s to remote branch %s?' % (this_branch, push_branch)):
 		print('Push canceled.')
-		exit(0)
+		sys.exit(0)
 	if (squash_merge := confirm('Squash push into single commit?')):
 		commit_msg_lines = []
 		print('Enter squashed commit message: (hit enter twice to finish message)')
@@ -49,106 +63,151 @@ def main():
 		commit_msg = '\n'.join(commit_msg_lines)
 		if len(commit_msg.strip()) == 0:
 			print('Empty messages are not allowed!')
-			exit(1)
+			sys.exit(1)
 	else:
 		commit_msg = 'Merge from %s to %s' % (this_branch, push_branch)
+	push_branch_local_name = local_name(push_branch)
+	this_remote_branch = '%s/%s' % (remote_name, this_branch)
+	this_on_remote = this_remote_branch in remote_branches
+	## bring the remote-tracking branches that will be pushed up to date (one round trip per remote). The
+	## push at the end only goes through if the remote still has these tips, so nothing fetched later can
+	## be overwritten. Not needed if the full fetch above just happened.
+	if not fetched: fetch([push_branch] + ([this_remote_branch] if this_on_remote and this_branch != push_branch_local_name else []))
+	check_before_push(this_branch, 'refs/remotes/' + push_branch)
 	# If pushing to a different branch than the current branch:
-	push_branch_local_name = push_branch
-	if '/' in push_branch_local_name: push_branch_local_name = push_branch_local_name[push_branch_local_name.rfind('/')+1:]
+	on_push_branch = False
 	if this_branch != push_branch_local_name:
 		## different branches
-		# Checkout push-to branch
-		run('git', 'switch', push_branch_local_name)
-		# Pull push-to branch
-		run('git', 'pull', '--ff-only', remote_name, push_branch_local_name)
-		# Merge current branch into push-to branch
-		if squash_merge:
-			run('git', 'merge', '--squash', this_branch, '-m', commit_msg)
-		else:
-			if not test_run('git', 'merge', this_branch, '-m', commit_msg, hide_output=False):
+		## first try to merge in memory, which never touches the working tree
+		if not merge_without_checkout(this_branch, push_branch_local_name, push_branch, squash_merge, commit_msg):
+			## merge conflicts (or git can't merge in memory), so merge in the working tree instead
+			# Checkout push-to branch
+			run('git', 'switch', push_branch_local_name)
+			on_push_branch = True
+			# Fast-forward push-to branch to the fetched remote branch (same as `git pull --ff-only`)
+			run('git', 'merge', '--ff-only', 'refs/remotes/' + push_branch,
+				fail_msg='Error: %s and %s have diverged, please merge them first.' % (push_branch_local_name, push_branch))
+			# Merge current branch into push-to branch
+			merge_start = time.time()
+			if squash_merge:
+				merged = test_run('git', 'merge', '--squash', this_branch, hide_output=False)
+			else:
+				merged = test_run('git', 'merge', this_branch, '-m', commit_msg, hide_output=False)
+			if not merged:
 				print('Error: unable to cleanly merge branches')
-				run('git', 'merge', '--abort')
-				run('git', 'clean', '-f')
+				record_merge_artifacts(list_unresolved(), merge_start)
+				## a squash merge leaves no MERGE_HEAD, so `git merge --abort` can't undo it
+				run('git', 'reset', '--merge')
+				clean_merge_artifacts()
 				run('git', 'switch', this_branch)
 				print('Please merge from %s into %s and resolve conflicts, then try again.' % (push_branch, this_branch))
-				exit(1)
+				sys.exit(1)
+			## git merge --squash only stages the changes, the commit is made here (unless it was already merged)
+			if squash_merge and not test_run('git', 'diff', '--cached', '--quiet'):
+				run('git', 'commit', '-m', commit_msg)
 	else:
-		# Pull push-to branch
-		run('git', 'pull', '--ff-only', remote_name, push_branch_local_name)
-	# Try to push
-	run('git', 'push', remote_name, push_branch_local_name)
+		# Fast-forward push-to branch to the fetched remote branch (same as `git pull --ff-only`)
+		run('git', 'merge', '--ff-only', 'refs/remotes/' + push_branch,
+			fail_msg='Error: %s and %s have diverged, please merge them first.' % (push_branch_local_name, push_branch))
 	# If push-to branch is different from this branch, ask user if they want to delete the current branch
+	## (asked before pushing, so everything goes to the remote in one push)
+	delete_this_branch = push_this_branch = set_upstream = False
 	if this_branch != push_branch_local_name:
-		if confirm('Delete branch %s?' % this_branch):
-			# If yes, delete current branch
-			run('git', 'branch', '-D', this_branch)
+		if this_on_remote:
+			delete_this_branch = confirm('Delete branch %s (here and on the remote)?' % this_branch)
+			# If no, ask use if they want to update current branch upstream
+			if not delete_this_branch: push_this_branch = confirm('Push this branch as well?')
 		else:
-			# If no, ask use if they want to add/update current branch to upstream
-			run('git', 'switch', this_branch)
-			if this_branch in remote_branches \
-					or this_branch in [x[x.rfind('/')+1:] for x in remote_branches if '/' in x]:
-				## corresponding remote branch exists
-				if confirm('Push this branch as well?'):
-					run('git', 'push', remote_name, this_branch)
-			else:
-				## branch not in upstream
-				if confirm('Add this branch to remote repository?'):
-					# If yes, add or push current branch to remote respository
-					run('git', 'push', '--set-upstream', remote_name, this_branch)
+			delete_this_branch = confirm('Delete branch %s?' % this_branch)
+			# If no, ask use if they want to add current branch to remote respository
+			if not delete_this_branch: push_this_branch = set_upstream = confirm('Add this branch to remote repository?')
+	# Push everything at once, the remote takes all of it or none
+	push_atomic(remote_name, push_branch_local_name, push_branch, this_branch, this_remote_branch,
+				delete_this_branch, push_this_branch, set_upstream, on_push_branch)
+	if delete_this_branch:
+		## (git can't delete the checked-out branch)
+		if not on_push_branch: run('git', 'switch', push_branch_local_name)
+		run('git', 'branch', '-D', this_branch)
+	elif on_push_branch:
+		run('git', 'switch', this_branch)
 	print('Done!')
 #
-def ask_for_text(msg, **kwargs):
-	print("%s: " % msg, **kwargs)
-	return input()
-def confirm(msg):
-	while True:
-		r = input('%s [y/n]: ' % msg).strip().lower()
-		if r == 'y' or r == 'yes':
-			return True
-		elif r == 'n' or r == 'no':
-			return False
-		else:
-			continue
-def choose_from(msg, options_list):
-	while True:
-		try:
-			print(msg)
-			num = 1
-			for opt in options_list:
-				print('%s:\t%s' % (num, opt))
-				num += 1
-			r = input('Enter number: ')
-			i = int(r)-1
-			return i, options_list[i]
-		except ValueError:
-			print('Not a number, try again.')
-		except IndexError:
-			print('Not a valid option, try again.')
-def run(command, *args, fail_msg=None, capture_stdout=False):
-	args = list(args) # convert tuple to list
-	if fail_msg == None:
-		fail_msg = "Error: non-zero exit code returned by %s %s" % (command," ".join(args))
-	if capture_stdout == False:
-		exit_code = call([command]+args)
-		ret_val = None
+def check_before_push(this_branch, remote_branch=None):
+	## runs the configured checks on the files this branch changed (the working tree is clean, so it has them as committed)
+	remote_tip = None if remote_branch is None else cat_file().resolve(remote_branch)
+	if not run_checks(unpushed_changes(this_branch, remote_tip)) and not confirm('Push anyway?'):
+		print('Push canceled.')
+		sys.exit(1)
+#
+def push_atomic(remote_name, push_branch_local_name, push_branch, this_branch, this_remote_branch,
+				delete_this_branch, push_this_branch, set_upstream, on_push_branch):
+	## One `git push --atomic` with every refspec. Each ref is guarded with --force-with-lease on the tip
+	## it had when it was fetched, so if someone pushed to it since, the whole push is rejected and nothing
+	## on the remote changes.
+	remote_tip, this_remote_tip = [None if x is None else x[0] for x in cat_file().query_many(
+		['refs/remotes/' + push_branch, 'refs/remotes/' + this_remote_branch])]
+	updates = [(push_branch_local_name, remote_tip)]
+	if delete_this_branch and this_remote_tip is not None:
+		updates.append((None, this_remote_tip))
+	if push_this_branch:
+		## the lease would allow overwriting the remote branch, but this push must only add commits
+		if this_remote_tip is not None and not test_run('git', 'merge-base', '--is-ancestor', this_remote_tip, 'refs/heads/' + this_branch):
+			print('Error: %s has commits that are not in %s, nothing was pushed. Please merge them first.' % (this_remote_branch, this_branch))
+			if on_push_branch: run('git', 'switch', this_branch)
+			sys.exit(1)
+		updates.append((this_branch, this_remote_tip))
+	args = ['git', 'push', '--atomic']
+	if set_upstream: args.append('--set-upstream')
+	refspecs = []
+	for branch, tip in updates:
+		remote_ref = 'refs/heads/' + (this_branch if branch is None else branch)
+		## an empty lease means the remote branch must not exist yet
+		args.append('--force-with-lease=%s:%s' % (remote_ref, '' if tip is None else tip))
+		refspecs.append(':' + remote_ref if branch is None else 'refs/heads/%s:%s' % (branch, remote_ref))
+	if not test_run(*(args + [remote_name] + refspecs), hide_output=False):
+		print('Error: the push was rejected and nothing on the remote was changed. If someone else pushed in the meantime, run push.py again.')
+		if on_push_branch: run('git', 'switch', this_branch)
+		sys.exit(1)
+#
+def merge_without_checkout(this_branch, push_branch_local_name, push_branch, squash_merge, commit_msg):
+	## Does the fast-forward to the fetched remote branch, merge (or squash) of this_branch into the push-to branch with plumbing commands, so
+	## the working tree and index are never touched. Returns False, without changing anything, if there
+	## are merge conflicts or the branches have diverged, so the caller can fall back to a regular merge.
+	## git merge-tree --write-tree needs git 2.38 or later
+	this_tip, remote_tip, local_tip = [None if x is None else x[0] for x in cat_file().query_many(
+		['refs/heads/' + this_branch, 'refs/remotes/' + push_branch, 'refs/heads/' + push_branch_local_name])]
+	if this_tip is None or remote_tip is None:
+		return False
+	## same as `git pull --ff-only`: the local push-to branch can only move forward to the remote one
+	if local_tip is None or test_run('git', 'merge-base', '--is-ancestor', local_tip, remote_tip):
+		base = remote_tip
+	elif test_run('git', 'merge-base', '--is-ancestor', remote_tip, local_tip):
+		base = local_tip
 	else:
-		p = Popen([command]+args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		o, e = p.communicate()
-		if e is not None and len(e) > 0: print(e.decode('utf8'), file=sys.stderr)
-		ret_val = o.decode('utf8')
-		exit_code = p.returncode
-	if exit_code != 0:
-		print(fail_msg)
-		exit(1)
-	return ret_val
-def test_run(command, *args, hide_output=True):
-	args = list(args)
-	if hide_output:
-		p = Popen([command] + args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		exit_code = p.wait()
+		return False
+	p = Popen(['git', 'merge-tree', '--write-tree', '--no-messages', base, this_tip], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	if p.returncode != 0:
+		return False # conflicts, or git too old
+	tree = o.decode('utf8').split('\n')[0].strip()
+	if squash_merge:
+		if tree == cat_file().resolve(base + '^{tree}'):
+			new_tip = base # nothing to squash
+		else:
+			new_tip = run('git', 'commit-tree', tree, '-p', base, '-m', commit_msg, capture_stdout=True).strip()
+	elif test_run('git', 'merge-base', '--is-ancestor', base, this_tip):
+		## git merge would fast-forward
+		new_tip = this_tip
+	elif test_run('git', 'merge-base', '--is-ancestor', this_tip, base):
+		## already merged
+		new_tip = base
 	else:
-		exit_code = call([command] + args)
-	return exit_code == 0
+		new_tip = run('git', 'commit-tree', tree, '-p', base, '-p', this_tip, '-m', commit_msg, capture_stdout=True).strip()
+	## only move the push-to branch if nobody else moved it in the meantime (an empty old value means it must not exist yet)
+	run('git', 'update-ref', '-m', 'better-git push: merge %s' % this_branch, 'refs/heads/' + push_branch_local_name,
+		new_tip, '' if local_tip is None else local_tip)
+	print('Merged %s into %s' % (this_branch, push_branch_local_name))
+	return True
 #
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Indexes of branch names, so that checking whether a name is taken, finding the next free auto-name
+## (eg main.3) and completing a partly typed name don't scan the whole list of branches each time.
+## Exact lookups use a dict, prefix lookups a sorted list and bisect (the same way refsnapshot.py
+## searches packed-refs), so both cost about the length of the name no matter how many branches exist.
+import bisect, re
+from refsnapshot import ref_snapshot
+
+SUFFIX_PATTERN = re.compile('^(.*)\\.(\\d+)$')
+
+class NameIndex:
+	def __init__(self, names):
+		self.names = list(names)
+		self.positions = {} # name -> index in names
+		for i, n in enumerate(self.names): self.positions.setdefault(n, i)
+		self.sorted_names = sorted(self.positions)
+	def __contains__(self, name):
+		return name in self.positions
+	def __len__(self):
+		return len(self.names)
+	def position(self, name):
+		## index of name in the list the index was made from, or None
+		return self.positions.get(name)
+	def complete(self, prefix, limit=None):
+		## sorted names that start with prefix (at most limit of them)
+		i = bisect.bisect_left(self.sorted_names, prefix)
+		matches = []
+		while i < len(self.sorted_names) and self.sorted_names[i].startswith(prefix):
+			if limit is not None and len(matches) >= limit: break
+			matches.append(self.sorted_names[i])
+			i += 1
+		return matches
+	def count(self, prefix):
+		## number of names that start with prefix
+		## (every name starting with prefix sorts before prefix followed by the highest character)
+		return bisect.bisect_left(self.sorted_names, prefix + '\U0010ffff') - bisect.bisect_left(self.sorted_names, prefix)
+
+class RefIndex:
+	## local branches and remote-tracking branches of a ref snapshot
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+		self.local = NameIndex(snapshot.branches())
+		self.remote = NameIndex(snapshot.remote_branches())
+		self.remote_short = {} # branch name without the remote (eg main) -> remote branches (eg [origin/main])
+		for r in self.remote.names:
+			self.remote_short.setdefault(local_name(r), []).append(r)
+		self.suffixes = {} # base name -> numbers used after it (main.1, main.2 -> {'main': {1, 2}})
+		for n in self.local.names + list(self.remote_short):
+			if (m := SUFFIX_PATTERN.match(n)) is not None:
+				self.suffixes.setdefault(m.group(1), set()).add(int(m.group(2)))
+	def is_taken(self, name):
+		## True if there is a local branch or a remote branch (on any remote) with this name
+		return name in self.local or name in self.remote_short
+	def on_remote(self, name):
+		## True if a remote has a branch with this name
+		return name in self.remote_short
+	def next_free_name(self, base):
+		## the first of base.1, base.2, ... that is not taken
+		used = self.suffixes.get(base, ())
+		i = 1
+		while i in used: i += 1
+		return '%s.%s' % (base, i)
+
+def local_name(remote_branch):
+	## name of a remote-tracking branch without the remote, eg origin/release/x -> release/x
+	return remote_branch.split('/', 1)[1] if '/' in remote_branch else remote_branch
+
+_index = None
+def ref_index(refresh=False):
+	## the index of the shared ref snapshot (see ref_snapshot()), made again whenever the snapshot is.
+	## Returns None if not in a git repository.
+	global _index
+	snapshot = ref_snapshot(refresh)
+	if snapshot is None: return None
+	if _index is None or _index.snapshot is not snapshot:
+		_index = RefIndex(snapshot)
+	return _index
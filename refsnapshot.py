@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Reads HEAD and the branch lists straight from the .git folder instead of spawning `git symbolic-ref`
+## and `git for-each-ref` for each list. The git dir is located once (honoring GIT_DIR, GIT_COMMON_DIR
+## and linked worktrees), loose refs are read when the snapshot is taken, and packed-refs is mmap'd and
+## binary searched. git replaces packed-refs by renaming a new file over it, so the mapped file can't
+## change underneath the snapshot. Repositories using the reftable backend are read with git instead.
+from subprocess import PIPE, DEVNULL
+import os, mmap, bisect
+from os import path
+from gittrace import Popen
+from daemonclient import daemon_request
+
+class GitDir:
+	## where the repository lives: git_dir holds HEAD and the per-worktree files (eg MERGE_HEAD),
+	## common_dir holds refs/ and packed-refs (they are the same folder unless this is a linked worktree)
+	def __init__(self, git_dir, common_dir, work_tree):
+		self.git_dir = git_dir
+		self.common_dir = common_dir
+		self.work_tree = work_tree
+	def uses_reftable(self):
+		if path.isdir(path.join(self.common_dir, 'reftable')):
+			return True
+		try:
+			with open(path.join(self.common_dir, 'config'), 'r') as fin:
+				config = fin.read().replace(' ', '').replace('\t', '').lower()
+			return 'refstorage=reftable' in config
+		except OSError:
+			return False
+
+def find_git_dir(start=None):
+	## returns a GitDir, or None if not in a git repository
+	git_dir = os.environ.get('GIT_DIR')
+	work_tree = os.environ.get('GIT_WORK_TREE')
+	if git_dir is not None:
+		git_dir = path.abspath(git_dir)
+		if work_tree is None: work_tree = os.getcwd()
+	else:
+		d = path.abspath(start if start is not None else os.getcwd())
+		while True:
+			dot_git = path.join(d, '.git')
+			if path.isdir(dot_git):
+				git_dir, work_tree = dot_git, d
+				break
+			if path.isfile(dot_git):
+				## linked worktree or submodule: .git is a file that says where the git dir is
+				with open(dot_git, 'r') as fin:
+					content = fin.read().strip()
+				if content.startswith('gitdir:'):
+					git_dir, work_tree = path.normpath(path.join(d, content[7:].strip())), d
+					break
+			if path.isfile(path.join(d, 'HEAD')) and path.isdir(path.join(d, 'objects')) and path.isdir(path.join(d, 'refs')):
+				## bare repository
+				git_dir, work_tree = d, None
+				break
+			parent = path.dirname(d)
+			if parent == d:
+				return None
+			d = parent
+	common_dir = os.environ.get('GIT_COMMON_DIR')
+	if common_dir is None:
+		common_dir = git_dir
+		commondir_file = path.join(git_dir, 'commondir')
+		if path.isfile(commondir_file):
+			with open(commondir_file, 'r') as fin:
+				common_dir = path.normpath(path.join(git_dir, fin.read().strip()))
+	return GitDir(git_dir, common_dir, work_tree)
+
+class PackedRefs:
+	## a sorted packed-refs file, mmap'd and binary searched by ref name
+	def __init__(self, filename):
+		self.mm = None
+		self.start = 0
+		if not path.isfile(filename) or path.getsize(filename) == 0:
+			return
+		with open(filename, 'rb') as fin:
+			self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.mm[0:1] == b'#':
+			header_end = self.mm.find(b'\n') + 1
+			if b' sorted' not in self.mm[0:header_end]:
+				self.mm.close()
+				raise ValueError('packed-refs is not sorted')
+			self.start = header_end
+	def _record(self, pos):
+		## returns (record start, record end, ref name, hash) for the record containing byte pos
+		mm = self.mm
+		ls = mm.rfind(b'\n', self.start, pos) + 1
+		if ls == 0: ls = self.start
+		if mm[ls:ls+1] == b'^':
+			## peeled tag line, belongs to the ref on the line before it
+			ls = mm.rfind(b'\n', self.start, ls - 1) + 1
+			if ls == 0: ls = self.start
+		le = mm.find(b'\n', ls)
+		if le < 0: le = len(mm)
+		oid, name = mm[ls:le].split(b' ', 1)
+		end = le + 1
+		if mm[end:end+1] == b'^':
+			end = mm.find(b'\n', end)
+			end = len(mm) if end < 0 else end + 1
+		return ls, end, name.decode('utf8'), oid.decode('ascii')
+	def _lower_bound(self, name):
+		lo, hi = self.start, len(self.mm)
+		while lo < hi:
+			rs, rend, rname, _ = self._record((lo + hi) // 2)
+			if rname < name:
+				lo = rend
+			else:
+				hi = rs
+		return lo
+	def find(self, name):
+		if self.mm is None: return None
+		pos = self._lower_bound(name)
+		if pos >= len(self.mm): return None
+		_, _, rname, oid = self._record(pos)
+		return oid if rname == name else None
+	def iter_prefix(self, prefix):
+		if self.mm is None: return
+		pos = self._lower_bound(prefix)
+		while pos < len(self.mm):
+			_, end, rname, oid = self._record(pos)
+			if not rname.startswith(prefix): break
+			yield rname, oid
+			pos = end
+	def close(self):
+		if self.mm is not None: self.mm.close()
+		self.mm = None
+
+class SortedRefs:
+	## same interface as PackedRefs, for refs that had to be read some other way (git, unsorted packed-refs)
+	def __init__(self, refs):
+		## (sorting by str is the same as git's byte order, because UTF-8 preserves code point order)
+		self.refs = sorted(refs)
+		self.names = [r[0] for r in self.refs]
+	def find(self, name):
+		i = bisect.bisect_left(self.names, name)
+		if i < len(self.refs) and self.refs[i][0] == name: return self.refs[i][1]
+		return None
+	def iter_prefix(self, prefix):
+		i = bisect.bisect_left(self.names, prefix)
+		while i < len(self.refs) and self.refs[i][0].startswith(prefix):
+			yield self.refs[i]
+			i += 1
+	def close(self):
+		pass
+
+class RefSnapshot:
+	def __init__(self, git_dir, refs=None, head=None):
+		self.dir = git_dir
+		self.loose = {} # ref name -> hash or 'ref: <target>'
+		if refs is not None:
+			## (name, hash) pairs and HEAD from the repository daemon (see repodaemon.py)
+			self.packed = SortedRefs([tuple(r) for r in refs])
+			self.head = head
+		elif git_dir.uses_reftable():
+			self.packed = SortedRefs(_git_refs())
+			self.head = _git_head()
+		else:
+			try:
+				self.packed = PackedRefs(path.join(git_dir.common_dir, 'packed-refs'))
+			except ValueError:
+				self.packed = SortedRefs(_read_unsorted_packed_refs(path.join(git_dir.common_dir, 'packed-refs')))
+			self._read_loose_refs()
+			self.head = _read_ref_file(path.join(git_dir.git_dir, 'HEAD'))
+		self.loose_names = sorted(self.loose)
+	def _read_loose_refs(self):
+		refs_dir = path.join(self.dir.common_dir, 'refs')
+		for root, _, files in os.walk(refs_dir):
+			rel = path.relpath(root, self.dir.common_dir).replace(os.sep, '/')
+			for f in files:
+				if f.endswith('.lock'): continue
+				value = _read_ref_file(path.join(root, f))
+				if value is not None: self.loose[rel + '/' + f] = value
+	def _raw(self, name):
+		if name in self.loose: return self.loose[name]
+		return self.packed.find(name)
+	def resolve(self, name, depth=0):
+		## returns the hash a full ref name (or 'HEAD') points to, following symbolic refs, or None
+		value = self.head if name == 'HEAD' else self._raw(name)
+		if value is not None and value.startswith('ref:') and depth < 5:
+			return self.resolve(value[4:].strip(), depth + 1)
+		return value
+	def head_ref(self):
+		## full name of the checked-out branch, or None if the HEAD is detached
+		if self.head is not None and self.head.startswith('ref:'):
+			return self.head[4:].strip()
+		return None
+	def current_branch(self):
+		## same as `git symbolic-ref --short -q HEAD` (empty string if the HEAD is detached)
+		ref = self.head_ref()
+		if ref is None: return ''
+		return ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+	def list(self, prefix):
+		## sorted (full ref name, hash) pairs under prefix, like `git for-each-ref <prefix>`
+		refs = {}
+		for name, oid in self.packed.iter_prefix(prefix): refs[name] = oid
+		i = bisect.bisect_left(self.loose_names, prefix)
+		while i < len(self.loose_names) and self.loose_names[i].startswith(prefix):
+			refs[self.loose_names[i]] = self.resolve(self.loose_names[i])
+			i += 1
+		return [(n, refs[n]) for n in sorted(refs) if refs[n] is not None]
+	def branches(self):
+		## short names of the local branches, like `git for-each-ref --format %(refname:short) refs/heads/`
+		return [n[len('refs/heads/'):] for n, _ in self.list('refs/heads/')]
+	def remote_branches(self):
+		## short names of the remote-tracking branches (eg origin/main)
+		return [n[len('refs/remotes/'):] for n, _ in self.list('refs/remotes/')]
+	def close(self):
+		self.packed.close()
+
+def _read_ref_file(filename):
+	try:
+		with open(filename, 'r') as fin:
+			value = fin.read().strip()
+		return value if len(value) > 0 else None
+	except (OSError, UnicodeDecodeError):
+		return None
+def _read_unsorted_packed_refs(filename):
+	refs = []
+	with open(filename, 'r') as fin:
+		for ln in fin:
+			if ln.startswith('#') or ln.startswith('^') or ' ' not in ln: continue
+			oid, name = ln.rstrip('\n').split(' ', 1)
+			refs.append((name, oid))
+	return refs
+def _git_refs():
+	p = Popen(['git', 'for-each-ref', '--format', '%(objectname) %(refname)'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	return [tuple(reversed(ln.split(' ', 1))) for ln in o.decode('utf8').replace('\r', '').split('\n') if ' ' in ln]
+def _git_head():
+	p = Popen(['git', 'symbolic-ref', '-q', 'HEAD'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	if p.returncode == 0: return 'ref: ' + o.decode('utf8').strip()
+	p = Popen(['git', 'rev-parse', '-q', '--verify', 'HEAD'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+	o, _ = p.communicate()
+	return o.decode('utf8').strip() if p.returncode == 0 else None
+
+_snapshot = None
+def ref_snapshot(refresh=False):
+	## the snapshot shared by all the better-git commands, taken on first use (or again after refs have
+	## changed, eg after a fetch, with refresh=True). Returns None if not in a git repository.
+	global _snapshot
+	if _snapshot is None or refresh:
+		if _snapshot is not None: _snapshot.close()
+		git_dir = find_git_dir()
+		reply = None if git_dir is None else daemon_request(git_dir.git_dir, 'refs')
+		if reply is not None:
+			_snapshot = RefSnapshot(git_dir, reply['refs'], reply['head'])
+		else:
+			_snapshot = None if git_dir is None else RefSnapshot(git_dir)
+	return _snapshot
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Optional background process, one per repository, that keeps the answers the better-git commands ask
+## for again and again (the refs, `git remote` and pages of history) and serves them over
+## a Unix socket in the git dir. The commands ask it first (see daemonclient.py) and ask git themselves
+## if it isn't running.
+##
+## usage: python3 repodaemon.py start [--idle SECONDS]    (run in the repository)
+##        python3 repodaemon.py stop|status
+##
+## A cached answer is thrown away when the files it depends on change: the refs when HEAD, packed-refs
+## or a folder under refs/ is modified (git writes refs by renaming a new file into place, which
+## updates the folder), the remotes when the config changes. History pages are cached by the commit
+## they start from, so they never go stale. `git status` is not cached: edits to files that are not
+## staged change nothing the daemon could watch cheaply, and a stale answer would let the
+## uncommitted-changes checks pass with a dirty working tree. The daemon exits after --idle seconds
+## without requests (default 600).
+from subprocess import DEVNULL
+import os, sys, json, time, threading, socket, socketserver
+from os import path
+from gittrace import Popen
+from refsnapshot import find_git_dir, RefSnapshot
+from daemonclient import socket_path, daemon_request
+from core import git_output
+
+DEFAULT_IDLE_TIMEOUT = 600
+MAX_LOG_PAGES = 256
+
+class RepoDaemon:
+	def __init__(self, git_dir):
+		self.dir = git_dir
+		self.lock = threading.Lock()
+		self.cache = {} # name -> (stamp, answer)
+		self.log_pages = {} # (tip, start, count) -> (exit code, lines), in order of use
+		self.last_request = time.monotonic()
+		self.stopping = False
+		self.hits = 0
+		self.misses = 0
+	def handle(self, request):
+		self.last_request = time.monotonic()
+		op = request.get('op')
+		if op == 'ping':
+			return {'pid': os.getpid(), 'hits': self.hits, 'misses': self.misses}
+		elif op == 'stop':
+			self.stopping = True
+			return {'pid': os.getpid()}
+		elif op == 'refs':
+			head, refs = self._cached('refs', self._refs_stamp(), self._read_refs)
+			return {'head': head, 'refs': refs}
+		elif op == 'remotes':
+			return {'remotes': self._cached('remotes', self._file_stamp(self.dir.common_dir, 'config'), self._read_remotes)}
+		elif op == 'log':
+			return self._log_page(str(request['tip']), int(request['start']), int(request['count']))
+		return {'error': 'unknown request "%s"' % op}
+	def _cached(self, name, stamp, compute):
+		with self.lock:
+			entry = self.cache.get(name)
+			if entry is not None and entry[0] == stamp:
+				self.hits += 1
+				return entry[1]
+			self.misses += 1
+		## computed outside the lock, so a slow git call doesn't hold up the other requests
+		answer = compute()
+		with self.lock:
+			self.cache[name] = (stamp, answer)
+		return answer
+	def _log_page(self, tip, start, count):
+		from branch import read_log_page
+		key = (tip, start, count)
+		with self.lock:
+			page = self.log_pages.pop(key, None)
+			if page is not None:
+				self.hits += 1
+				self.log_pages[key] = page # most recently used last
+		if page is None:
+			self.misses += 1
+			page = read_log_page(tip, start, count)
+			with self.lock:
+				self.log_pages[key] = page
+				while len(self.log_pages) > MAX_LOG_PAGES:
+					del self.log_pages[next(iter(self.log_pages))]
+		return {'code': page[0], 'lines': page[1]}
+	def _refs_stamp(self):
+		stamp = [self._file_stamp(self.dir.git_dir, 'HEAD'), self._file_stamp(self.dir.common_dir, 'packed-refs')]
+		for root, _, _ in os.walk(path.join(self.dir.common_dir, 'refs')):
+			stamp.append((root, self._file_stamp(root)))
+		return tuple(stamp)
+	def _file_stamp(self, *parts):
+		try:
+			st = os.stat(path.join(*parts))
+			return st.st_mtime_ns, st.st_size
+		except OSError:
+			return None
+	def _read_refs(self):
+		snapshot = RefSnapshot(self.dir)
+		try:
+			return snapshot.head, snapshot.list('refs/')
+		finally:
+			snapshot.close()
+	def _read_remotes(self):
+		return git_output('remote')
+
+def serve(idle_timeout):
+	git_dir = find_git_dir()
+	if git_dir is None or git_dir.work_tree is None:
+		print('Error: not in a git working tree')
+		sys.exit(1)
+	os.chdir(git_dir.work_tree)
+	daemon = RepoDaemon(git_dir)
+	sock = socket_path(git_dir.git_dir)
+	if path.exists(sock): os.remove(sock) # left behind by a daemon that didn't exit cleanly
+	class Handler(socketserver.StreamRequestHandler):
+		def handle(self):
+			try:
+				reply = daemon.handle(json.loads(self.rfile.readline()))
+			except Exception as e:
+				reply = {'error': str(e)}
+			self.wfile.write(json.dumps(reply).encode('utf8') + b'\n')
+	class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+		daemon_threads = True
+	os.umask(0o077) # only this user can connect
+	with Server(sock, Handler) as server:
+		server.timeout = 1.0
+		try:
+			while not daemon.stopping and time.monotonic() - daemon.last_request < idle_timeout:
+				server.handle_request()
+		finally:
+			if path.exists(sock): os.remove(sock)
+
+def start(idle_timeout):
+	git_dir = find_git_dir()
+	if git_dir is None:
+		print('Error: not in a git repository')
+		sys.exit(1)
+	if (reply := daemon_request(git_dir.git_dir, 'ping')) is not None:
+		print('The better-git daemon is already running for this repository (pid %s)' % reply['pid'])
+		return
+	Popen([sys.executable, path.abspath(__file__), 'serve', '--idle', str(idle_timeout)], stdin=DEVNULL, stdout=DEVNULL,
+		  stderr=DEVNULL, close_fds=True, start_new_session=True)
+	## wait for it to answer
+	for _ in range(50):
+		time.sleep(0.1)
+		if (reply := daemon_request(git_dir.git_dir, 'ping')) is not None:
+			print('Started the better-git daemon for this repository (pid %s)' % reply['pid'])
+			return
+	print('Error: the better-git daemon did not start')
+	sys.exit(1)
+
+def main():
+	args = sys.argv[1:]
+	idle_timeout = DEFAULT_IDLE_TIMEOUT
+	if '--idle' in args:
+		i = args.index('--idle')
+		idle_timeout = float(args[i+1])
+		del args[i:i+2]
+	command = args[0] if len(args) > 0 else None
+	if command == 'start':
+		start(idle_timeout)
+	elif command == 'serve':
+		serve(idle_timeout)
+	elif command in ('stop', 'status'):
+		git_dir = find_git_dir()
+		reply = None if git_dir is None else daemon_request(git_dir.git_dir, 'stop' if command == 'stop' else 'ping')
+		if reply is None:
+			print('The better-git daemon is not running for this repository')
+		elif command == 'stop':
+			print('Stopped the better-git daemon (pid %s)' % reply['pid'])
+		else:
+			print('The better-git daemon is running (pid %s, %s cache hits, %s misses)' % (reply['pid'], reply['hits'], reply['misses']))
+	else:
+		print('usage: python3 repodaemon.py start|stop|status [--idle SECONDS]')
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
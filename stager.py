@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Stages all changes like `git add --all`, but faster when there are large new or modified files. Most of
+## the time `git add` spends on a big file goes into compressing it into an object, one file after
+## another. Here the changed files, as listed by the caller's status scan, are first split into shards
+## of about the same number of bytes and written as objects by one `git hash-object -w --stdin-paths`
+## per CPU, all at the same time. Then the caller's `git add --all` updates the index in one go; it
+## finds the objects already written, so all that is left for it to do is check the hashes. Because git
+## add still makes the final decision about every path (file modes, symlinks, submodules, deletions,
+## filters), the index ends up exactly as it would with `git add --all` alone.
+from subprocess import PIPE, DEVNULL
+import os, sys, stat, threading
+from os import path
+from gittrace import Popen
+from refsnapshot import ref_snapshot
+
+## below this many bytes of changes, starting the workers costs more than it saves
+PARALLEL_THRESHOLD = 32 * 1024 * 1024
+
+def write_changed_objects(paths, show_progress=True):
+	## run before `git add --all` with the paths changed in the working tree (eg StatusScan.work_tree_paths());
+	## does nothing outside a working tree, on a single CPU or when the changes are small
+	refs = ref_snapshot()
+	if refs is None or refs.dir.work_tree is None or (os.cpu_count() or 1) < 2: return
+	files = changed_files(refs.dir.work_tree, paths)
+	if sum(size for _, size in files) >= PARALLEL_THRESHOLD:
+		write_objects(refs.dir.work_tree, files, show_progress)
+def changed_files(work_tree, paths):
+	## (path, size) of the regular files among paths (relative to work_tree) that still exist
+	files = []
+	for f in dict.fromkeys(paths):
+		## --stdin-paths reads one path per line
+		if len(f) == 0 or '\n' in f: continue
+		try:
+			st = os.lstat(path.join(work_tree, f))
+		except OSError:
+			continue # deleted
+		if stat.S_ISREG(st.st_mode): files.append((f, st.st_size))
+	return files
+def write_objects(work_tree, files, show_progress=True, jobs=None):
+	## writes the objects of files, a list of (path, size), in parallel
+	jobs = min(jobs or os.cpu_count() or 4, len(files))
+	## biggest files first, each to the shard with the fewest bytes so far, so the shards finish together
+	shards = [[] for _ in range(jobs)]
+	shard_bytes = [0] * jobs
+	for f, size in sorted(files, key=lambda x: -x[1]):
+		i = shard_bytes.index(min(shard_bytes))
+		shards[i].append((f, size))
+		shard_bytes[i] += size
+	total = sum(shard_bytes)
+	done = [0, 0] # bytes, files
+	lock = threading.Lock()
+	def hash_shard(shard):
+		p = Popen(['git', '-C', work_tree, 'hash-object', '-w', '--stdin-paths'], stdin=PIPE, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+		## feed the paths from another thread, so a full stdout pipe can't block both sides
+		def feed():
+			try:
+				for f, _ in shard: p.stdin.write(f.encode('utf8', errors='surrogateescape') + b'\n')
+				p.stdin.close()
+			except OSError:
+				pass
+		feeder = threading.Thread(target=feed, daemon=True)
+		feeder.start()
+		for _, size in shard:
+			if len(p.stdout.readline().strip()) == 0: break # hash-object failed, git add will deal with the rest
+			with lock:
+				done[0] += size
+				done[1] += 1
+				if show_progress:
+					print('\rWriting objects: %s / %s (%s of %s files)' % (_size(done[0]), _size(total), done[1], len(files)),
+						  end='', file=sys.stderr, flush=True)
+		feeder.join()
+		p.wait()
+	threads = [threading.Thread(target=hash_shard, args=(s,)) for s in shards if len(s) > 0]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	if show_progress: print('\r' + ' ' * 70 + '\r', end='', file=sys.stderr, flush=True)
+
+def _size(n):
+	for unit in ('B', 'KB', 'MB', 'GB'):
+		if n < 1024 or unit == 'GB': return ('%.1f %s' % (n, unit)) if unit != 'B' else '%s B' % n
+		n /= 1024
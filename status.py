@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# Author: Dr. Christopher C. Hall, aka DrPlantabyte
+# Copyright 2021 Christopher C. Hall
+# Permission granted to use and redistribute this code in accordance with the Creative Commons (CC BY 4.0) License:
+# https://creativecommons.org/licenses/by/4.0/
+## Streaming parser for `git status --porcelain=v2 -z`. The status is read once, in chunks, and reduced to
+## per-directory counts of added/modified/deleted/renamed files; the full listing is spilled to a
+## temporary file so memory stays bounded no matter how many files changed, and can be printed on demand.
+## Once everything is staged, scan_staged() gives the same listing from the index alone (`git diff
+## --cached`), without looking at the working tree again.
+from subprocess import PIPE, DEVNULL
+import sys
+from os import path
+from gittrace import Popen
+
+CATEGORIES = {'A': 'added', 'M': 'modified', 'D': 'deleted', 'R': 'renamed', 'C': 'copied', 'T': 'modified', 'U': 'unmerged', '?': 'untracked'}
+CATEGORY_ORDER = ['added', 'modified', 'deleted', 'renamed', 'copied', 'unmerged', 'untracked']
+
+class StatusScan:
+	def __init__(self):
+		self.total = 0
+		self.dir_counts = {} # directory -> {category: count}
+		self.totals = {}
+		import tempfile
+		self._listing = tempfile.TemporaryFile()
+		self._work_tree_paths = tempfile.TemporaryFile() # \0-separated paths changed in the working tree
+	def scan(self, show_progress=True):
+		## returns False if git status failed (eg not in a git repository)
+		p = Popen(['git', 'status', '--porcelain=v2', '-z', '-uall'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+		remainder = b''
+		rename_pending = None
+		while len(chunk := p.stdout.read(1 << 16)) > 0:
+			fields = (remainder + chunk).split(b'\0')
+			remainder = fields.pop()
+			for field in fields:
+				if rename_pending is not None:
+					## the second field of a rename/copy record is the original path
+					self._add(rename_pending[0], rename_pending[1], field.decode('utf8', errors='replace'))
+					rename_pending = None
+				else:
+					rename_pending = self._parse(field.decode('utf8', errors='replace'))
+			if show_progress and self.total > 0:
+				print('\rScanning changes: %s files' % self.total, end='', file=sys.stderr, flush=True)
+		if show_progress and self.total > 0:
+			print('\r' + ' ' * 40 + '\r', end='', file=sys.stderr, flush=True)
+		return p.wait() == 0
+	def scan_staged(self, show_progress=True):
+		## like scan(), but only the changes staged in the index; returns False if git diff failed
+		p = Popen(['git', 'diff', '--cached', '--name-status', '-z', '-M'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=True)
+		remainder = b''
+		record = [] # status, then one path, or two for a rename/copy
+		while len(chunk := p.stdout.read(1 << 16)) > 0:
+			fields = (remainder + chunk).split(b'\0')
+			remainder = fields.pop()
+			for field in fields:
+				record.append(field.decode('utf8', errors='replace'))
+				if len(record) == (3 if record[0][0:1] in ('R', 'C') else 2):
+					## porcelain v2 codes, with the working tree side unchanged
+					self._add(record[0][0] + '.', record[-1], record[1] if len(record) == 3 else None)
+					record = []
+			if show_progress and self.total > 0:
+				print('\rScanning changes: %s files' % self.total, end='', file=sys.stderr, flush=True)
+		if show_progress and self.total > 0:
+			print('\r' + ' ' * 40 + '\r', end='', file=sys.stderr, flush=True)
+		return p.wait() == 0
+	def _parse(self, record):
+		## returns (xy, path) if the record continues in the next field, otherwise None
+		kind = record[0:1]
+		if kind == '1':
+			parts = record.split(' ', 8)
+			self._add(parts[1], parts[8])
+		elif kind == '2':
+			parts = record.split(' ', 9)
+			return parts[1], parts[9]
+		elif kind == 'u':
+			parts = record.split(' ', 10)
+			self._add('UU', parts[10])
+		elif kind == '?':
+			self._add('??', record[2:])
+		return None
+	def _add(self, xy, file_path, orig_path=None):
+		code = xy[0] if xy[0] != '.' else xy[1]
+		category = CATEGORIES.get(code, 'modified')
+		self.total += 1
+		counts = self.dir_counts.setdefault(path.dirname(file_path), {})
+		counts[category] = counts.get(category, 0) + 1
+		self.totals[category] = self.totals.get(category, 0) + 1
+		line = '%s %s' % (xy.replace('.', ' '), file_path if orig_path is None else '%s -> %s' % (orig_path, file_path))
+		self._listing.write(line.encode('utf8') + b'\n')
+		if xy[1] != '.':
+			self._work_tree_paths.write(file_path.encode('utf8') + b'\0')
+	def work_tree_paths(self):
+		## the paths that are new or changed in the working tree but not staged yet
+		self._work_tree_paths.flush()
+		self._work_tree_paths.seek(0)
+		paths = [f.decode('utf8') for f in self._work_tree_paths.read().split(b'\0')[:-1]]
+		self._work_tree_paths.seek(0, 2)
+		return paths
+	def print_all(self):
+		self._listing.flush()
+		self._listing.seek(0)
+		for ln in self._listing:
+			print(ln.decode('utf8').rstrip('\n'))
+		self._listing.seek(0, 2)
+	def print_summary(self, max_rows=40):
+		## per-directory counts, with directories rolled up into their parents until it fits in max_rows
+		depth = max([0] + [d.count('/') + 1 for d in self.dir_counts if len(d) > 0])
+		while True:
+			rows = {}
+			for d, counts in self.dir_counts.items():
+				key = '/'.join(d.split('/')[:depth]) if len(d) > 0 else ''
+				row = rows.setdefault(key, {})
+				for c, n in counts.items(): row[c] = row.get(c, 0) + n
+			if len(rows) <= max_rows or depth == 0: break
+			depth -= 1
+		for d in sorted(rows):
+			print('%s/: %s' % (d if len(d) > 0 else '.', _describe(rows[d])))
+		print('Total: %s files (%s)' % (self.total, _describe(self.totals)))
+	def print_changes(self, max_files=40):
+		## prints the full listing if it is short, otherwise the per-directory summary.
+		## Returns True if only the summary was shown.
+		if self.total <= max_files:
+			self.print_all()
+			return False
+		self.print_summary()
+		return True
+	def close(self):
+		self._listing.close()
+		self._work_tree_paths.close()
+
+def scan_status(show_progress=True):
+	## returns a StatusScan of the working tree, or None if git status failed
+	status = StatusScan()
+	if not status.scan(show_progress):
+		status.close()
+		return None
+	return status
+def scan_staged(show_progress=True):
+	## returns a StatusScan of the changes staged in the index, or None if git diff failed
+	status = StatusScan()
+	if not status.scan_staged(show_progress):
+		status.close()
+		return None
+	return status
+def _describe(counts):
+	return ', '.join('%s %s' % (counts[c], c) for c in CATEGORY_ORDER if c in counts)